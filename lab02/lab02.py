@@ -13,184 +13,290 @@ https://www.geeksforgeeks.org/visualize-data-from-csv-file-in-python/
 https://matplotlib.org/stable/tutorials/introductory/usage.html#sphx-glr-tutorials-introductory-usage-py
 '''
 
+import argparse
+from contextlib import redirect_stdout
+import json
+import os
 from os.path import exists
+import sys
+import numpy as np
 import pandas as pd
 import csv
 import matplotlib.pyplot as plt
 
+DATA_FILE = 'lab02\\data_table_for_daily_case_trends__the_united_states.csv'
+
+CHUNK_ROWS = 100000 # rows per chunk when copy_data streams the file through pandas
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+class CovidDataset:
+  '''
+  Parse-once handle for the CDC daily case trends file.
+  Keeps the file title, the generation/run-date line, the column names and the typed dataframe. The file's mtime and
+  size are recorded at load time, and the file is only parsed again when either of them has changed.
+  '''
+
+  def __init__(self, input_file):
+    self.input_file = input_file
+    self._stamp = None
+    self._title = None
+    self._generation = None
+    self._columns = None
+    self._df = None
+
+  def _file_stamp(self):
+    stat = os.stat(self.input_file)
+    return (stat.st_mtime_ns, stat.st_size)
+
+  def reload(self):
+    '''
+    Parse the file: the first two rows hold the title and the generation/run-date, the third row holds the column names.
+    'Date' is parsed into datetime objects and the case columns are read as integers.
+    '''
+    stamp = self._file_stamp()
+
+    with open(self.input_file, encoding = 'utf-8-sig') as infile:
+      self._title = next(infile)
+      self._generation = next(infile)
+      self._columns = [col.strip() for col in next(infile).split(',')]
+      df = pd.read_csv(infile, names = self._columns, header = None)
+
+    df['Date'] = pd.to_datetime(df['Date'], format = '%b %d %Y')
+    self._df = df
+    self._stamp = stamp
+
+    return self
+
+  def refresh(self):
+    '''
+    Reload the file only if its mtime or size changed since the last parse.
+    '''
+    if self._stamp is None or self._file_stamp() != self._stamp:
+      self.reload()
+
+    return self
+
+  @property
+  def title(self):
+    return self.refresh()._title
+
+  @property
+  def generation(self):
+    return self.refresh()._generation
+
+  @property
+  def columns(self):
+    return self.refresh()._columns
+
+  @property
+  def df(self):
+    return self.refresh()._df
+
+
+def iter_rows(input_file):
+  '''
+  Lazily iterate over the rows of a csv file.
+  Yields one parsed row (list of strings) at a time, so only the current row is held in memory.
+  '''
+  with open(input_file, newline='') as infile:
+    for row in csv.reader(infile):
+      yield row
+
+
 def duplicate_data(input_file, output_file):
   '''
   Duplicate the original file's data into an output csv file, and save it into the project directory.
-  Opens and reads from an input file and writes into an output file. Reader object used to read from the input file and writer object used to copy all data from the input file into the output file (using a delimiter to separate
-  file contents). Writer iterates over each row in the input file and appends the file information to the data list.
+  Rows are streamed one at a time from iter_rows() into a csv writer (which writes '\r\n' line endings, like the
+  original output), instead of collecting every row in memory.
 
-  Returns the list containing the duplicated data.
+  Returns the number of rows copied. Use iter_rows() to walk the duplicated rows lazily.
   '''
-  data = []
-  with open(input_file) as infile, open(output_file, 'w', newline='') as outfile:
-    reader = csv.reader(infile)
+  copied = 0
+  with open(output_file, 'w', newline='') as outfile:
     writer = csv.writer(outfile, delimiter=',')
 
-    for row in reader:
+    for row in iter_rows(input_file):
       writer.writerow(row)
-      data.append(row)
+      copied += 1
 
   print('\t...File was duplicated to duplicate.csv')
 
-  return data
+  return copied
+
+
+def infer_dtypes(input_file, chunksize = CHUNK_ROWS):
+  '''
+  Infer the type of every column of the data rows over the whole file, one chunk at a time.
+  Numeric types of the chunks are combined with numpy's promotion rules (e.g. int64 and float64 give float64), and any
+  other mix falls back to object, the same types pandas infers when reading the whole file at once.
+
+  Returns a dictionary of column name to dtype.
+  '''
+  dtypes = {}
+  for chunk in pd.read_csv(input_file, header = 2, chunksize = chunksize):
+    for column, dtype in chunk.dtypes.items():
+      if column not in dtypes or dtypes[column] == dtype:
+        dtypes[column] = dtype
+      elif dtypes[column].kind in 'biuf' and dtype.kind in 'biuf':
+        dtypes[column] = np.result_type(dtypes[column], dtype)
+      else:
+        dtypes[column] = np.dtype(object)
+
+  return dtypes
 
 
-def copy_data(input_file, output_file):
+def copy_data(input_file, output_file, chunksize = CHUNK_ROWS):
   '''
   Copy data from the original file (skipping rows that do not contain actual data) into an output file.
   Assigns header to second row by index and skips over the first three rows. Uses pandas module to read input file
-  as a pandas dataframe and copies the original data into the output file as a csv file.
+  in chunks of `chunksize` rows and appends each chunk to the output file as csv, so memory use stays constant no
+  matter how large the input file is.
+  Column types are inferred over the whole file first (see infer_dtypes) and passed to every chunk, so the output
+  matches reading the file in one piece (e.g. a column with a blank cell anywhere is written as floats in every row).
+
+  Returns the number of data rows copied.
   '''
-  df = pd.read_csv(input_file, header = 2)
-  df.to_csv(output_file, header = False)
+  copied = 0
+  dtypes = infer_dtypes(input_file, chunksize)
+
+  with open(output_file, 'w', newline='') as outfile:
+    for chunk in pd.read_csv(input_file, header = 2, chunksize = chunksize, dtype = dtypes):
+      chunk.to_csv(outfile, header = False)
+      copied += len(chunk)
 
   print('\t...The data from the original file was copied to copy_data.csv')
 
+  return copied
 
-def display_title(input_file):
+
+def display_title(dataset):
   '''
   Extract and display the file title.
-  Opens file and assigns title to next(infile), but returns only the title row.
-  Prints the file title and encoding utf-8-sig removes special characters from the beginning of the row.
+  Prints the title row kept by the dataset (read with encoding utf-8-sig, which removes special characters from the beginning of the row).
   '''
-  with open(input_file, encoding = 'utf-8-sig') as infile:
-    title = next(infile)
-    print(title, end = '')
+  print(dataset.title, end = '')
   
   print('\n\t...File title was displayed.')
 
+  return dataset.title.strip()
+
 
-def display_generation(input_file):
+def display_generation(dataset):
   '''
   Extract and display the file generation/run-date.
-  Opens file and uses next to iterate over file title until file generation row is reached.
-  Prints the file generation/run-date from index 1 (or the next row after title). 
+  Prints the file generation/run-date kept by the dataset (the next row after title).
   '''
-  with open(input_file) as infile:
-    title = next(infile)
-    run_date = next(infile)
-    print(run_date, end = '')
+  print(dataset.generation, end = '')
 
   print('\n\t...File generation/run-date was displayed.')
 
+  return dataset.generation.strip()
 
-def display_col_names(input_file):
+
+def display_col_names(dataset):
   '''
   Extract and display the column names as a list.
-  Opens file and uses a counter to iterate through each line until line 3 (index 2) is reached.
-  Returns a copy of the line with whitespace removed, and separates each list value with a comma.
+  Prints the column names (line 3, index 2) kept by the dataset, with whitespace removed.
   '''
-  with open(input_file) as infile:
-    count = 0
-    while (count <= 2):
-      line = next(infile)
-
-      if (count == 2):
-        print([col.strip() for col in line.split(',')])
-
-      count += 1
+  print(dataset.columns)
 
   print('\n\t...Row column names was displayed.')
 
+  return dataset.columns
 
-def display_data(input_file):
+
+def display_data(dataset):
   '''
   Extract and display data from file as a list of lists.
-  Reads input file as a pandas dataframe, ignoring the header (indexes 0,1,2).
-  Prints dataframe values as a list of lists.
+  Prints the dataset's dataframe values as a list of lists.
   '''
-  df = pd.read_csv(input_file, header = 2)
-  print(df.values)
+  print(dataset.df.values)
 
   print('\n\t...File data as a list was displayed.')
 
+  return dataset.df
+
 
-def display_recent_days(input_file):
+def display_recent_days(dataset):
   '''
   Extract and display the most recent five days of data.
-  Reads in file as a dataframe, ignoring the first few lines. Prints the head (first five values) of the dataframe, using the 'Date' and 'New Cases' labels.
+  Prints the head (first five values) of the dataset's dataframe, using the 'Date' and 'New Cases' labels.
   '''
   print('The Five Most Recent Cases:\n')
-  df = pd.read_csv(input_file, header = 2)
-  print(df.head()[['Date', 'New Cases']])
+  recent = dataset.df.head()[['Date', 'New Cases']]
+  print(recent)
 
   print('\n\t...The most recent five days of data was displayed.')
 
+  return recent
 
-def get_highest_cases(input_file):
+
+def get_highest_cases(dataset):
   '''
   Extract and display the highest number of cases on a single day.
-  Uses a dataframe to extract values based on the 'New Cases' label, and returns the maximum value from this column.
+  Uses the dataset's dataframe to extract values based on the 'New Cases' label, and returns the maximum value from this column.
   '''
-  df = pd.read_csv(input_file, header = 2)
+  highest = dataset.df['New Cases'].max()
   print('The Highest Number of Cases on a Single Day:\n')
   print('New Cases: ', end = '')
-  print(df['New Cases'].max())
+  print(highest)
 
   print('\n\t...The highest number of cases on a single day was displayed.')
 
+  return highest
+
 
-def ten_highest_days(input_file):
+def ten_highest_days(dataset):
   '''
   Extract and display the highest ten days of cases.
-  Uses a dataframe to sort values by 'New Cases', and filters the highest value based on the corresponding 'Date'.
-  Returns and prints the maximum value as a string.
+  Uses nlargest on 'New Cases' (a partial selection instead of sorting the whole dataframe) to select the ten highest
+  days with their corresponding 'Date'. Ties keep the earlier row in file order (the more recent day).
+  Prints the ten days as a string and returns them as a dataframe.
   '''
-  df = pd.read_csv(input_file, header = 2)
+  highest = dataset.df.nlargest(10, 'New Cases', keep = 'first')[['Date', 'New Cases']]
 
   print('The Highest Ten Days of Cases:\n')
-  print(df.sort_values(by='New Cases', ascending = False)
-        [0:9][['Date', 'New Cases']].to_string(index = False))
+  print(highest.to_string(index = False))
 
   print('\n\t...The highest ten days of cases was displayed.')
 
+  return highest
 
-def monthly_summary(input_file):
+
+def monthly_summary(dataset, pivot = False):
   '''
   Extract and display a summary of each month of data provided, in a formatted display.
-  '''
-  df = pd.read_csv(input_file, header = 2, index_col = False)
-  df = df.rename(columns={'Date': 'Month'}) # rename 'Date' column to 'Month'
+  Groups 'New Cases' by calendar month (year and month, so the same month of different years is kept apart) using
+  dt.to_period('M'), and computes the count, average, sum, minimum and maximum in a single groupby pass.
+  If pivot is True, the average cases are also displayed as a year x month table.
 
-  # Convert data column to datetime objects
-  df['Month'] = pd.to_datetime(df['Month'])
-  # Format to month(s) only
-  df['Month'] = df['Month'].apply(
-    lambda data: data.strftime('%b'))
-
-  # Create counts Series
-  cts = pd.DataFrame()
-  cts['Count'] = 1
-  cts['Count'] = df.groupby('Month')['New Cases'].count()
-
-  # Create averages Series
-  avgs = pd.DataFrame()
-  avgs['Average Cases'] = 1
-  avgs['Average Cases'] = df.groupby('Month')['New Cases'].mean()
+  Returns the monthly summary dataframe.
+  '''
+  df = dataset.df
+  months = df.groupby(df['Date'].dt.to_period('M'))['New Cases'].agg(['count', 'mean', 'sum', 'min', 'max'])
+  months.index.name = 'Month'
+  months.columns = ['Count', 'Average Cases', 'Total Cases', 'Lowest Cases', 'Highest Cases']
 
-  # Merge averages and counts
-  months = pd.merge(cts, avgs, on='Month')
+  print(months)
 
-  # List months in order
-  months = months.reindex(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 
-                          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])
+  if pivot:
+    table = months['Average Cases'].groupby([months.index.year, months.index.month]).first().unstack()
+    table.index.name = 'Year'
+    table.columns = [MONTHS[month - 1] for month in table.columns]
 
-  print(months)
+    print('\nAverage Cases by Year and Month:\n')
+    print(table)
 
   print('\n\t...The summary of each month was displayed.')
 
+  return months
+
 
-def visualize_data(input_file):
+def visualize_data(dataset):
   '''
   Display summary of data as a bar graph, with historic cases being the y-axis and new cases being the x-axis.
   '''
-  df = pd.read_csv(input_file, header = 2)
-  df = df.describe()
+  df = dataset.df.describe()
 
   print('\tDisplaying graph...')
 
@@ -223,11 +329,12 @@ def user_options():
   return option
 
 
-def main():
+def main(input_file = DATA_FILE):
   '''
   Main method for running the lab module.
   '''
   print('Hi! Welcome to Lab 2.\n')
+  dataset = CovidDataset(input_file)
   user = input('Would you like to run a function? (Y/N): ')
 
   while(user.lower() == 'yes' or user.lower() == 'y'):
@@ -244,32 +351,32 @@ def main():
 
     if option == 1:
       if not exists('lab02\duplicate.csv'):
-        duplicate_data('lab02\data_table_for_daily_case_trends__the_united_states.csv', 'lab02\duplicate.csv')
+        duplicate_data(input_file, 'lab02\duplicate.csv')
       else:
         print('The file was already duplicated into the current project directory. This file already exists as \'duplicate.csv\'.')
     elif option == 2:
       if not exists('lab02\copy_data.csv'):
-        copy_data('lab02\data_table_for_daily_case_trends__the_united_states.csv', 'lab02\copy_data.csv')
+        copy_data(input_file, 'lab02\copy_data.csv')
       else:
         print('The file was already copied into the current project directory. This file already exists as \'copy_data.csv\'.')
     elif option == 3:
-      display_title('lab02\data_table_for_daily_case_trends__the_united_states.csv')
+      display_title(dataset)
     elif option == 4:
-      display_generation('lab02\data_table_for_daily_case_trends__the_united_states.csv')
+      display_generation(dataset)
     elif option == 5:
-      display_col_names('lab02\data_table_for_daily_case_trends__the_united_states.csv')
+      display_col_names(dataset)
     elif option == 6:
-      display_data('lab02\data_table_for_daily_case_trends__the_united_states.csv')
+      display_data(dataset)
     elif option == 7:
-      display_recent_days('lab02\data_table_for_daily_case_trends__the_united_states.csv')
+      display_recent_days(dataset)
     elif option == 8:
-      get_highest_cases('lab02\data_table_for_daily_case_trends__the_united_states.csv')
+      get_highest_cases(dataset)
     elif option == 9:
-      ten_highest_days('lab02\data_table_for_daily_case_trends__the_united_states.csv')
+      ten_highest_days(dataset)
     elif option == 10:
-      monthly_summary('lab02\data_table_for_daily_case_trends__the_united_states.csv')
+      monthly_summary(dataset)
     elif option == 11:
-      visualize_data('lab02\data_table_for_daily_case_trends__the_united_states.csv')
+      visualize_data(dataset)
     elif option == 0:
       break
     
@@ -279,5 +386,95 @@ def main():
   print('Thank you.')
 
 
+# batch mode commands (see cli()) mapped to the menu functions that read from the dataset; duplicate and copy work on the file
+COMMANDS = {
+  'title': display_title,
+  'generation': display_generation,
+  'columns': display_col_names,
+  'data': display_data,
+  'recent-days': display_recent_days,
+  'highest-cases': get_highest_cases,
+  'ten-highest-days': ten_highest_days,
+  'monthly-summary': monthly_summary,
+}
+
+
+def to_frame(result):
+  '''
+  Convert a command result (dataframe, series, list or scalar) to a dataframe with its row labels as a column.
+  '''
+  if isinstance(result, pd.Series):
+    result = result.to_frame()
+  elif isinstance(result, list):
+    result = pd.DataFrame({'value': result})
+  elif not isinstance(result, pd.DataFrame):
+    result = pd.DataFrame({'value': [result]})
+
+  if result.index.name is not None:
+    result = result.reset_index()
+
+  # periods (monthly summary) are not json serializable
+  for column in result.columns:
+    if isinstance(result[column].dtype, pd.PeriodDtype):
+      result[column] = result[column].astype('str')
+
+  return result
+
+
+def write_results(results, format, outfile):
+  '''
+  Write command results as a json object keyed by command, or as one csv table with a leading command column.
+  '''
+  if format == 'json':
+    payload = {name: json.loads(to_frame(result).to_json(orient = 'records', date_format = 'iso')) for name, result in results}
+    json.dump(payload, outfile, indent = 2)
+    outfile.write('\n')
+  else:
+    frames = [to_frame(result).assign(command = name) for name, result in results]
+    table = pd.concat(frames, ignore_index = True).convert_dtypes() # keep counts as integers next to missing cells
+    table = table[['command'] + [column for column in table.columns if column != 'command']]
+    table.to_csv(outfile, index = False, lineterminator = '\n')
+
+
+def cli(argv = None):
+  '''
+  Command line entry point. With commands, parses the file once, runs every command over it and writes the results as
+  json or csv to stdout (progress messages go to stderr). Without commands, starts the interactive menu.
+  '''
+  parser = argparse.ArgumentParser(description = 'Lab 2: CDC daily case trends.')
+  parser.add_argument('commands', nargs = '*', metavar = 'command',
+                      help = 'one or more of: duplicate, copy, {}'.format(', '.join(COMMANDS)))
+  parser.add_argument('--file', default = DATA_FILE, help = 'CDC daily case trends csv file')
+  parser.add_argument('--duplicate-file', default = 'lab02\\duplicate.csv', help = 'output file for duplicate')
+  parser.add_argument('--copy-file', default = 'lab02\\copy_data.csv', help = 'output file for copy')
+  parser.add_argument('--format', choices = ['json', 'csv'], default = 'json', help = 'output format (default: json)')
+  args = parser.parse_intermixed_args(argv) # commands may come before, between or after the options
+
+  unknown = [command for command in args.commands if command not in COMMANDS and command not in ('duplicate', 'copy')]
+  if unknown:
+    parser.error('unknown command(s): {}'.format(', '.join(unknown)))
+
+  if not args.commands:
+    main(args.file)
+    return 0
+
+  outfile = sys.stdout
+  dataset = CovidDataset(args.file)
+  results = []
+
+  with redirect_stdout(sys.stderr):
+    for command in args.commands:
+      if command == 'duplicate':
+        results.append((command, duplicate_data(args.file, args.duplicate_file)))
+      elif command == 'copy':
+        results.append((command, copy_data(args.file, args.copy_file)))
+      else:
+        results.append((command, COMMANDS[command](dataset)))
+
+  write_results(results, args.format, outfile)
+
+  return 0
+
+
 if __name__ == "__main__":
-  main()
+  sys.exit(cli())
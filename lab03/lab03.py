@@ -12,66 +12,340 @@ https://pandas.pydata.org/docs/reference/api/pandas.Timestamp.strftime.html
 https://docs.python.org/3/library/datetime.html#strftime-and-strptime-behavior
 '''
 
+import argparse
+from contextlib import redirect_stdout
 from datetime import date, timezone
 import datetime
-from io import StringIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import sys
+import tempfile
+import threading
+import numpy as np
 import pandas as pd
 import requests
 
+DATA_URL = 'https://data.cdc.gov/api/views/9mfq-cb36/rows.csv?accessType=DOWNLOAD'
+RESOURCE_URL = 'https://data.cdc.gov/resource/9mfq-cb36.csv' # SODA endpoint, accepts SoQL filters such as $where
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cdc_cache.parquet') # next to this script, wherever it is run from
+CHUNK_ROWS = 100000 # rows per chunk when parsing the streamed download
+COMMANDS = ['national-summary', 'state-summary', 'top-states', 'data-output'] # batch mode commands, see cli()
+
+# schema of the 9mfq-cb36 columns used by the lab: submission_date is parsed to datetime64, state is stored as a
+# category and the counts as the smallest nullable integer type that holds them
+DATE_FORMAT = '%m/%d/%Y'
+COUNT_COLUMNS = ['tot_cases', 'new_case', 'tot_death', 'new_death']
+COLUMNS = ['submission_date', 'state'] + COUNT_COLUMNS
+INT_TYPES = ['Int8', 'Int16', 'Int32', 'Int64']
+
 '''
 NOTE(S): Will need to install Jinja2 in order to process data output file. 
-Missing data in historic cases (do not know how to calculate). Timezone is not printing correctly (missing hour:minute:second status, as well as timezone.) Minor formatting issues.
+Historic cases are estimated from the daily change in total cases minus new cases. Timezone is not printing correctly (missing hour:minute:second status, as well as timezone.) Minor formatting issues.
 '''
 
-def national_summary(df: pd.DataFrame):
+def load_meta(cache_file=CACHE_FILE):
+  '''
+  Load the cache metadata (ETag, Last-Modified, latest submission_date), stored next to the Parquet file as json. Returns {} if there is none.
+  '''
+  meta_file = os.path.splitext(cache_file)[0] + '.json'
+
+  if not os.path.exists(meta_file):
+    return {}
+
+  with open(meta_file) as infile:
+    return json.load(infile)
+
+
+def load_cache(cache_file=CACHE_FILE):
+  '''
+  Load the cached dataset and its metadata (ETag, Last-Modified, latest submission_date). Returns (None, {}) if there is no cache yet.
+  '''
+  meta = load_meta(cache_file)
+
+  if not (os.path.exists(cache_file) and meta):
+    return None, {}
+
+  return pd.read_parquet(cache_file), meta
+
+
+def save_cache(df: pd.DataFrame, meta, cache_file=CACHE_FILE):
+  '''
+  Save the dataset as a Parquet file (requires pyarrow) and its metadata as json. The latest submission_date is recorded so the next start can fetch only newer rows.
+  The cache is best effort: if it cannot be written (no pyarrow, a read-only or missing directory) a warning is printed, the metadata is removed so a partial cache is never loaded, and False is returned.
+  '''
+  meta = dict(meta)
+  meta['max_submission_date'] = df['submission_date'].max().strftime('%Y-%m-%d')
+  meta_file = os.path.splitext(cache_file)[0] + '.json'
+
+  try:
+    df.to_parquet(cache_file, index=False)
+    with open(meta_file, 'w') as outfile:
+      json.dump(meta, outfile)
+  except (OSError, ImportError) as error:
+    print('\t...Could not save the cache ({}), continuing without it.\n'.format(error))
+    try:
+      os.remove(meta_file)
+    except OSError:
+      pass
+    return False
+
+  return True
+
+
+def coerce_chunk(chunk: pd.DataFrame, failures, date_format=DATE_FORMAT):
+  '''
+  Coerce one parsed chunk to the schema: submission_date to datetime64 and the counts to whole numbers. Values that cannot be coerced (bad dates, text or fractional counts) become missing, and are counted per column in failures.
+  '''
+  dates = pd.to_datetime(chunk['submission_date'], format=date_format, errors='coerce')
+  failures['submission_date'] += int((dates.isna() & chunk['submission_date'].notna()).sum())
+  chunk['submission_date'] = dates
+
+  for column in COUNT_COLUMNS:
+    values = pd.to_numeric(chunk[column], errors='coerce')
+    values = values.where(values % 1 == 0)
+    failures[column] += int((values.isna() & chunk[column].notna()).sum())
+    chunk[column] = values
+
+  return chunk
+
+
+def compact(df: pd.DataFrame):
+  '''
+  Store state as a category and downcast each count column to the smallest nullable integer type that holds its range.
+  '''
+  df['state'] = df['state'].astype('category')
+
+  for column in COUNT_COLUMNS:
+    low, high = df[column].min(), df[column].max()
+
+    for int_type in INT_TYPES:
+      info = np.iinfo(int_type.lower())
+      if pd.isna(low) or (info.min <= low and high <= info.max):
+        df[column] = df[column].astype(int_type)
+        break
+
+  return df
+
+
+def validate(failures):
+  '''
+  Report the columns with values that failed type coercion. Returns True if every value was coerced.
+  '''
+  failed = {column: count for column, count in failures.items() if count}
+
+  for column, count in failed.items():
+    print('\t...Column \'{}\' has {} value(s) that could not be coerced (set to missing).'.format(column, count))
+
+  return not failed
+
+
+def read_stream(response, chunksize=CHUNK_ROWS, date_format=DATE_FORMAT):
   '''
-  Display national summary of all states of the following categories: total_cases, total_new_cases, total_deaths, total_new_deaths. First fetch the national stats, then format print each result.
+  Parse a streamed (stream=True) csv response chunk by chunk. The raw byte stream is fed straight into pandas, so the response is never decoded into one big string; only the lab's columns are kept, and each chunk is coerced to the declared schema as it is read. Columns that fail coercion are reported.
+  '''
+  response.raw.decode_content = True # undo gzip/deflate transfer encoding while streaming
+  reader = pd.read_csv(response.raw, usecols=COLUMNS, dtype={'submission_date': 'str', 'state': 'str'}, chunksize=chunksize)
+  failures = dict.fromkeys(COLUMNS, 0)
+
+  df = pd.concat([coerce_chunk(chunk, failures, date_format) for chunk in reader], ignore_index=True)
+  validate(failures)
+
+  return compact(df)
+
+
+def fetch_rows_since(df: pd.DataFrame, since, resource_url=RESOURCE_URL):
+  '''
+  Fetch only the rows submitted after the cached latest submission_date through a SoQL $where filter, and merge them into the cached dataframe. Rows already in the cache (same state and submission_date) are replaced by the newer copy. Returns the merged dataframe, the fetched rows and the cached rows they replaced (for SummaryIndex.update).
+  '''
+  with requests.get(resource_url, params={'$where': "submission_date > '{}'".format(since), '$limit': 10000000}, stream=True, timeout=60) as response:
+    response.raise_for_status()
+    new = read_stream(response, date_format=None) # SODA returns ISO timestamps
+
+  key = ['state', 'submission_date']
+  df = df.astype({'state': 'str'})
+  added = new.astype({'state': 'str'}).drop_duplicates(subset=key, keep='last')
+  replaced = df[key].merge(added[key], on=key, how='left', indicator=True)['_merge'].eq('both').to_numpy()
+  removed = df[replaced]
+
+  df = pd.concat([df[~replaced], added], ignore_index=True)
+
+  return compact(df), added, removed
+
+
+def fetch_data(url=DATA_URL, cache_file=CACHE_FILE, resource_url=None):
+  '''
+  Retrieve the CDC dataset, using the on-disk cache when possible. With a cache, a conditional request (If-None-Match / If-Modified-Since) is sent and a 304 response reuses the cache; if resource_url is given, only rows newer than the cached latest submission_date are fetched instead. Without network access the cache is used as is. The full download is only made when there is no usable cache.
+  '''
+  df, meta = load_cache(cache_file)
+
+  try:
+    if df is not None and resource_url is not None:
+      df = fetch_rows_since(df, meta['max_submission_date'], resource_url)[0]
+      save_cache(df, meta, cache_file)
+      return df
+
+    headers = {}
+    if df is not None:
+      if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+      if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+      if response.status_code == 304 and df is not None:
+        print('\t...Cached data is up to date.\n')
+        return df
+
+      response.raise_for_status()
+      df = read_stream(response)
+
+    save_cache(df, {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}, cache_file)
+  except requests.RequestException:
+    if df is None:
+      raise
+    print('\t...Could not reach the CDC server, using cached data.\n')
+
+  return df
+
+
+def refresh_data(df: pd.DataFrame, summary, cache_file=CACHE_FILE, resource_url=RESOURCE_URL):
+  '''
+  Refresh a loaded dataset without a full reload: fetch only the rows submitted after its latest submission_date, merge them in, update the summary index with the new rows and the rows they replaced (instead of rebuilding it) and save the cache. Returns the merged dataframe.
+  '''
+  since = df['submission_date'].max().strftime('%Y-%m-%d')
+  df, added, removed = fetch_rows_since(df, since, resource_url)
+  summary.update(added, removed)
+  save_cache(df, load_meta(cache_file), cache_file)
+
+  print('\t...Refreshed: {} new row(s), {} replaced.'.format(len(added), len(removed)))
+
+  return df
+
+
+def stub_server(csv_file, port=0):
+  '''
+  Start a local HTTP stub server (test mode) that serves csv_file in place of the CDC server. Responses carry an ETag and Last-Modified header based on the file's mtime and size, and conditional requests get a 304 when the file has not changed. Returns the server (call shutdown() when done) and its base url.
+  '''
+  class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      stat = os.stat(csv_file)
+      etag = '"{}-{}"'.format(stat.st_mtime_ns, stat.st_size)
+
+      if self.headers.get('If-None-Match') == etag:
+        self.send_response(304)
+        self.end_headers()
+        return
+
+      with open(csv_file, 'rb') as infile:
+        body = infile.read()
+
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/csv')
+      self.send_header('Content-Length', str(len(body)))
+      self.send_header('ETag', etag)
+      self.send_header('Last-Modified', self.date_time_string(int(stat.st_mtime)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      pass
+
+  server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+
+  return server, 'http://127.0.0.1:{}/rows.csv'.format(server.server_address[1])
+
+
+class SummaryIndex:
+  '''
+  Per-state aggregate table over tot_cases, new_case, tot_death and new_death, plus the national totals, built once after the data is loaded. State lookups are dictionary hits instead of a boolean mask and four sums over the full dataframe. When a refresh brings in new rows, update() adds them (and takes out the rows they replace) without going over the full dataframe again.
+  '''
+
+  def __init__(self, df: pd.DataFrame):
+    self.states = self._aggregate(df)
+    self._rebuild()
+
+  @staticmethod
+  def _aggregate(df: pd.DataFrame):
+    # sum as int64 so the per-state totals do not overflow the compact count dtypes
+    return df.groupby('state', observed=True)[COUNT_COLUMNS].sum().astype('int64')
+
+  def _rebuild(self):
+    self.states.index = self.states.index.astype('str')
+    self.national = self.states.sum().to_dict()
+    self._lookup = self.states.to_dict('index')
+
+  def update(self, added: pd.DataFrame, removed: pd.DataFrame=None):
+    '''
+    Add the sums of newly arrived rows to the index. Rows that the refresh replaced (same state and submission_date) should be passed as removed so they are not counted twice.
+    '''
+    states = self.states.add(self._aggregate(added), fill_value=0)
+    if removed is not None and len(removed):
+      states = states.sub(self._aggregate(removed), fill_value=0)
+
+    self.states = states.astype('int64')
+    self._rebuild()
+
+    return self
+
+  def state(self, state):
+    '''
+    Return the totals of a state as a dictionary, or None if the state code is not in the data.
+    '''
+    return self._lookup.get(state)
+
+
+def national_summary(summary: SummaryIndex):
+  '''
+  Display national summary of all states of the following categories: total_cases, total_new_cases, total_deaths, total_new_deaths. The national stats are precomputed by the summary index, then format print each result.
   '''
   print('\n\tNational Summary (all states):\n')
 
-  total_cases = df['tot_cases'].sum()
-  total_new_cases = df['new_case'].sum()
-  total_death = df['tot_death'].sum()
-  total_new_death = df['new_death'].sum()
+  totals = summary.national
 
-  print('\t\tTotal Cases: {}'.format(total_cases))
-  print('\t\tTotal New Cases: {}'.format(total_new_cases))
-  print('\t\tTotal Deaths: {}'.format(total_death))
-  print('\t\tTotal New Deaths: {}'.format(total_new_death))
+  print('\t\tTotal Cases: {}'.format(totals['tot_cases']))
+  print('\t\tTotal New Cases: {}'.format(totals['new_case']))
+  print('\t\tTotal Deaths: {}'.format(totals['tot_death']))
+  print('\t\tTotal New Deaths: {}'.format(totals['new_death']))
 
   print('\n\t...National summary has finished.')
 
   
-def state_summary(df: pd.DataFrame):
+def state_summary(summary: SummaryIndex):
   '''
-  Display state summary based on user input (user should enter a two-character state code). State summary should display information about the following categories: total_cases, total_new_cases, total_deaths, total_new_deaths. First fetch selected state summary data based on state code, then format print each result. Check if entered state code is valid.
+  Display state summary based on user input (user should enter a two-character state code). State summary should display information about the following categories: total_cases, total_new_cases, total_deaths, total_new_deaths. First look up the selected state's totals in the summary index, then format print each result. Check if entered state code is valid.
   '''
   state = input('\n\tPlease enter a state (2-letter state code): ').upper()
-  
-  try: # does not catch properly, should put inside a while loop for validation check (int, single letter cases)
-    df = df.loc[df['state'] == state]
-  except ValueError:
+  totals = summary.state(state)
+
+  if totals is None:
     print('Invalid input. Please try again.')
     return False
 
   print('\n\tState Summary:\n')
 
-  total_cases = df['tot_cases'].sum()
-  total_new_cases = df['new_case'].sum()
-  total_death = df['tot_death'].sum()
-  total_new_death = df['new_death'].sum()
-
-  print('\t\tTotal Cases: {}'.format(total_cases))
-  print('\t\tTotal New Cases: {}'.format(total_new_cases))
-  print('\t\tTotal Deaths: {}'.format(total_death))
-  print('\t\tTotal New Deaths: {}'.format(total_new_death))
+  print('\t\tTotal Cases: {}'.format(totals['tot_cases']))
+  print('\t\tTotal New Cases: {}'.format(totals['new_case']))
+  print('\t\tTotal Deaths: {}'.format(totals['tot_death']))
+  print('\t\tTotal New Deaths: {}'.format(totals['new_death']))
 
   print('\n\t...State summary for {} has finished.'.format(state))
 
   return True
 
 
-def data_analysis(df: pd.DataFrame):
+def top_k(df: pd.DataFrame, k, columns=None):
+  '''
+  Select the k largest values of each column in one pass over the (already aggregated) dataframe. Uses nlargest, a partial selection that avoids sorting the full column. Ties keep the first row in index order, so a grouped dataframe (sorted by its group keys) always returns the same k rows. Returns a dictionary of column name to a Series with exactly k rows (or fewer if there are fewer rows).
+  '''
+  if columns is None:
+    columns = df.columns
+
+  return {column: df[column].nlargest(k, keep='first') for column in columns}
+
+
+def data_analysis(summary: SummaryIndex):
   '''
   Display the top number of states by summary statistics (total_cases, total_new_cases, total_deaths, total_new_deaths), based on user input. 
   '''
@@ -85,50 +359,47 @@ def data_analysis(df: pd.DataFrame):
 
   print('\n\tHere are the top {} states for the following categories: '.format(user))
 
-  states = df.groupby('state')
-
-  total_cases = states['tot_cases'].sum().sort_values(ascending=False)
-  total_new_cases = states['new_case'].sum().sort_values(ascending=False)
-  total_death = states['tot_death'].sum().sort_values(ascending=False)
-  total_new_death = states['new_death'].sum().sort_values(ascending=False)
+  top_states = top_k(summary.states, user)
 
   print('\n\tTotal Cases: ')
-  print(total_cases.head(user))
+  print(top_states['tot_cases'])
   
   print('\n\tTotal New Cases: ')
-  print(total_new_cases.head(user))
+  print(top_states['new_case'])
   
   print('\n\tTotal Deaths: ')
-  print(total_death.head(user))
+  print(top_states['tot_death'])
 
   print('\n\tTotal New Deaths: ')
-  print(total_new_death.head(user))
+  print(top_states['new_death'])
 
   print('\n\t...Data analysis has finished.')
 
   return True
 
 
-def data_output(df: pd.DataFrame):
+def data_output(df: pd.DataFrame, output_file='lab03\\data_output.csv'):
   '''
-  Process and output data into a new output file, similar to the COVID data file from lab 2. Create new columns for the 7 day averages and historic cases, set to zero. Rename columns to resemble lab 2 csv file. Figure out how to calculate historic and 7 day averages columns. Format date column and write row information to new output file. Format output to match original csv file.
+  Process and output data into a new output file, similar to the COVID data file from lab 2. Rename columns to resemble lab 2 csv file. The 7 day averages are a trailing rolling mean of new cases within each state (rows sorted by submission_date inside each state), and historic cases are the part of each day's change in total cases that was not reported as new cases (cases back-filled for earlier dates). Both are computed with vectorized groupby operations instead of row-wise applies. Format date column and write row information to new output file. Format output to match original csv file.
   '''
   print('\n\t...Writing data to \'data_output.csv\'...')
 
-  df['7-Day Moving Avg'] = 0
-  df['Historic Cases'] = 0
+  # widen the compact count dtypes first: nullable ints wrap around when diff() or the subtraction overflows them
+  df = df[['state', 'submission_date', 'new_case', 'tot_cases']].astype({'new_case': 'Int64', 'tot_cases': 'Int64'})
+  df = df.sort_values(by=['state', 'submission_date'], kind='stable')
 
-  df = df[['state', 'submission_date', 'new_case', '7-Day Moving Avg', 'Historic Cases']].sort_values (by='submission_date')
+  states = df.groupby('state', sort=False, observed=True)
 
-  df.rename(columns={'state': 'State', 'submission_date': 'Date', 'new_case': 'New Cases'}, inplace=True)
+  df['7-Day Moving Avg'] = states['new_case'].rolling(7, min_periods=1).mean().droplevel(0).round().astype('Int64')
+  df['Historic Cases'] = (states['tot_cases'].diff() - df['new_case']).clip(lower=0).fillna(0).round().astype('Int64')
 
-  df['7-Day Moving Avg'] = df.apply(lambda row: round(df['New Cases'][row.name:row.name + 7].mean()), axis=1)
+  df = df[['state', 'submission_date', 'new_case', '7-Day Moving Avg', 'Historic Cases']].sort_values(by='submission_date', kind='stable')
 
-  # df['Historic Cases'] = df.apply(lambda row: round(df[''])) # how to calculate this???
+  df.rename(columns={'state': 'State', 'submission_date': 'Date', 'new_case': 'New Cases'}, inplace=True)
 
-  df['Date'] = pd.to_datetime(df['Date']).apply(lambda date: date.strftime('%b %d %Y'))
+  df['Date'] = df['Date'].dt.strftime('%b %d %Y')
 
-  with open('lab03\data_output.csv', 'w') as outfile:
+  with open(output_file, 'w') as outfile:
     today = date.today()
     timezone = datetime.datetime.utcnow().astimezone().tzinfo
     outfile.write('Data Table for Daily Case Trends - The United States\n')
@@ -137,10 +408,12 @@ def data_output(df: pd.DataFrame):
 
   df.style.format('%20s')
 
-  df.to_csv('lab03\data_output.csv', index=False, mode='a')
+  df.to_csv(output_file, index=False, mode='a')
   
   print('\n\t...Finished processing the file.')
 
+  return output_file
+
 
 def user_options():
   '''
@@ -151,21 +424,22 @@ def user_options():
   print('\t[1] Display national summary.')
   print('\t[2] Display a state summary.')
   print('\t[3] Display a data analysis of the top states for each statistical category.')
-  print('\t[4] Process and output data into a csv file.\n')
+  print('\t[4] Process and output data into a csv file.')
+  print('\t[5] Refresh the data (fetch only new rows).\n')
 
   option = input('Please choose a function to run (enter number): ')
 
   return option
 
 
-def main():
+def main(url=DATA_URL, cache_file=CACHE_FILE, resource_url=RESOURCE_URL):
   '''
   Main method for running the lab module.
   '''
   print('Hi! Welcome to Lab 3.\n')
   print('\n\tRetrieving data...\n')
-  url = requests.get('https://data.cdc.gov/api/views/9mfq-cb36/rows.csv?accessType=DOWNLOAD')
-  df = pd.read_csv(StringIO(url.text))
+  df = fetch_data(url, cache_file)
+  summary = SummaryIndex(df)
 
   user = input('Would you like to run a function? (Y/N): ')
 
@@ -182,13 +456,15 @@ def main():
       print('Invalid option. Please try again.')
 
     if option == 1:
-      national_summary(df)
+      national_summary(summary)
     elif option == 2:
-      state_summary(df)
+      state_summary(summary)
     elif option == 3:
-      data_analysis(df)
+      data_analysis(summary)
     elif option == 4:
       data_output(df)
+    elif option == 5:
+      df = refresh_data(df, summary, cache_file, resource_url)
     elif option == 0:
       break
     
@@ -198,5 +474,112 @@ def main():
   print('Thank you.')
 
 
+def run_commands(df: pd.DataFrame, summary: SummaryIndex, commands, args):
+  '''
+  Run the menu options named in commands over one loaded dataset, without prompting. Returns a list of (name, result) pairs.
+  '''
+  results = []
+
+  for command in commands:
+    if command == 'national-summary':
+      results.append((command, summary.national))
+    elif command == 'state-summary':
+      unknown = [state for state in args.state if summary.state(state) is None]
+      if unknown:
+        raise ValueError('Unknown state code(s): {}'.format(', '.join(unknown)))
+      results.append((command, summary.states.loc[args.state]))
+    elif command == 'top-states':
+      for column, top in top_k(summary.states, args.top).items():
+        results.append(('{}:{}'.format(command, column), top))
+    elif command == 'data-output':
+      results.append((command, data_output(df, args.output)))
+
+  return results
+
+
+def to_frame(result):
+  '''
+  Convert a command result (dataframe, series, dictionary or scalar) to a dataframe with its row labels as a column.
+  '''
+  if isinstance(result, pd.Series):
+    result = result.to_frame()
+  elif isinstance(result, dict):
+    result = pd.DataFrame([result])
+  elif not isinstance(result, pd.DataFrame):
+    result = pd.DataFrame({'value': [result]})
+
+  if result.index.name is not None:
+    result = result.reset_index()
+
+  return result
+
+
+def write_results(results, format, outfile):
+  '''
+  Write command results as a json object keyed by command, or as one csv table with a leading command column.
+  '''
+  if format == 'json':
+    payload = {name: json.loads(to_frame(result).to_json(orient='records', date_format='iso')) for name, result in results}
+    json.dump(payload, outfile, indent=2)
+    outfile.write('\n')
+  else:
+    frames = [to_frame(result).assign(command=name) for name, result in results]
+    table = pd.concat(frames, ignore_index=True).convert_dtypes() # keep counts as integers next to missing cells
+    table = table[['command'] + [column for column in table.columns if column != 'command']]
+    table.to_csv(outfile, index=False, lineterminator='\n')
+
+
+def cli(argv=None):
+  '''
+  Command line entry point. With commands, loads the dataset once, runs every command over it and writes the results as json or csv to stdout (progress messages go to stderr). Without commands, starts the interactive menu.
+  '''
+  parser = argparse.ArgumentParser(description='Lab 3: CDC COVID-19 cases and deaths by state.')
+  parser.add_argument('commands', nargs='*', metavar='command', help='one or more of: {}'.format(', '.join(COMMANDS)))
+  parser.add_argument('--state', action='append', default=[], help='2-letter state code for state-summary (repeatable)')
+  parser.add_argument('--top', type=int, default=5, help='number of states for top-states (default: 5)')
+  parser.add_argument('--output', default='lab03\\data_output.csv', help='output file for data-output')
+  parser.add_argument('--format', choices=['json', 'csv'], default='json', help='output format (default: json)')
+  parser.add_argument('--refresh', action='store_true', help='fetch only the rows newer than the loaded data and update the summaries incrementally before running the commands')
+  parser.add_argument('--stub', metavar='CSV', help='test mode: serve a local csv file through a stub HTTP server instead of the CDC server (uses a temporary cache, never the real one)')
+  args = parser.parse_intermixed_args(argv) # commands may come before, between or after the options
+
+  unknown = [command for command in args.commands if command not in COMMANDS]
+  if unknown:
+    parser.error('unknown command(s): {}'.format(', '.join(unknown)))
+  if 'state-summary' in args.commands and not args.state:
+    parser.error('state-summary requires --state')
+  args.state = [state.upper() for state in args.state]
+
+  server, url = stub_server(args.stub) if args.stub else (None, DATA_URL)
+  # stub data must never end up in (or be served from) the real cache
+  stub_cache = tempfile.TemporaryDirectory() if args.stub else None
+  cache_file = os.path.join(stub_cache.name, 'cdc_cache.parquet') if args.stub else CACHE_FILE
+  resource_url = url if args.stub else RESOURCE_URL # the stub serves the whole file for any query
+
+  try:
+    if not args.commands:
+      main(url, cache_file, resource_url)
+      return 0
+
+    outfile = sys.stdout
+    with redirect_stdout(sys.stderr):
+      df = fetch_data(url, cache_file)
+      summary = SummaryIndex(df)
+      if args.refresh:
+        df = refresh_data(df, summary, cache_file, resource_url)
+      try:
+        results = run_commands(df, summary, args.commands, args)
+      except ValueError as error:
+        parser.error(str(error))
+
+    write_results(results, args.format, outfile)
+  finally:
+    if server is not None:
+      server.shutdown()
+      stub_cache.cleanup()
+
+  return 0
+
+
 if __name__ == "__main__":
-  main()
+  sys.exit(cli())
@@ -7,6 +7,16 @@ Resources: https://pandas.pydata.org/docs/getting_started/intro_tutorials/03_sub
 '''
 
 # import modules
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from functools import reduce
+import glob
+import inspect
+import json
+import os
+import sys
+import weakref
 import numpy as np
 import pandas as pd
 import matplotlib as mpl
@@ -14,6 +24,34 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from scipy import stats
 
+DATA_FILE = os.path.join("lab04", "heart_2020_cleaned.csv")
+
+# declared dtypes of the heart disease dataset: Yes/No columns are read as bool, low-cardinality text columns as
+# categories and the numeric columns as float32
+YES_NO_COLUMNS = ["HeartDisease", "Smoking", "AlcoholDrinking", "Stroke", "DiffWalking", "PhysicalActivity",
+                  "Asthma", "KidneyDisease", "SkinCancer"]
+CATEGORY_COLUMNS = ["Sex", "AgeCategory", "Race", "Diabetic", "GenHealth"]
+FLOAT_COLUMNS = ["BMI", "PhysicalHealth", "MentalHealth", "SleepTime"]
+DTYPES = {**dict.fromkeys(YES_NO_COLUMNS, "bool"), **dict.fromkeys(CATEGORY_COLUMNS, "category"),
+          **dict.fromkeys(FLOAT_COLUMNS, "float32")}
+
+NUMERIC_COLUMNS = FLOAT_COLUMNS + ["AgeCategory"] # AgeCategory once converted into mean ages
+CHUNK_ROWS = 100000 # rows per chunk when streaming the csv file
+SKETCH_SIZE = 1000 # centroids kept by each quantile sketch (rank error of about 1/SKETCH_SIZE)
+
+# above this many rows, plotCorrelative draws the histograms, KDE curves and boxplots from precomputed summaries
+BINNED_THRESHOLD = 50000
+KDE_GRID = 1024 # number of grid points of the binned KDE
+
+# mean age of each AgeCategory, used to convert it from categorical to continuous data
+MEAN_AGE = {'55-59':57, '80 or older':80, '65-69':67,
+            '75-79':77,'40-44':42,'70-74':72,'60-64':62,
+            '50-54':52,'45-49':47,'18-24':21,'35-39':37,
+            '30-34':32,'25-29':27}
+# batch mode commands, see cli()
+COMMANDS = ["outliers", "summary", "stats", "correlative", "predictive", "correlation", "analysis", "plot"]
+STREAM_COMMANDS = ["outliers", "summary", "stats", "correlative", "predictive", "correlation"] # commands that can run over a streamed file (--stream)
+
 def dataAnalysis(df):
   shape = df.shape
   print("Shape: {}".format(shape))
@@ -28,40 +66,124 @@ def dataAnalysis(df):
   print("\nChecking for Missing Values:")
   print(df.isnull().sum())
 
-def getOutliers(df, column):
-  max = round(df[column].max(), 2)
-  min = round(df[column].min(), 2)
+  return df.describe()
+
+# data is a dataframe or the RunningStats of a streamed file (see streamStats); both statistics come from the same
+# single pass. float() first: rounding a float32 value keeps float32 noise (e.g. 28.0699996948)
+def getOutliers(data, column):
+  summary = getStats(data).summary()
+  max = round(float(summary.loc[column, "max"]), 2)
+  min = round(float(summary.loc[column, "min"]), 2)
 
   return max, min
 
-def getSummary(df, column):
-  avg = round(df[column].mean(), 2)
-  values = df[["BMI", "AgeCategory", "SleepTime"]]
-  # print(values.describe())
-  # sum_all = round(df[["BMI", "AgeCategory", "SleepTime"]].sum(), 2)
-  sum = round(df["BMI"].sum(), 2)
+def getSummary(data, column):
+  summary = getStats(data).summary()
+  avg = round(float(summary.loc[column, "mean"]), 2)
+  sum = round(float(summary.loc[column, "sum"]), 2)
 
   return sum, avg
 
+# cache for the numeric results below, keyed by dataframe; an entry is dropped when its dataframe is garbage collected
+_cache = {}
+
+def cached(df, key, compute):
+  key = (id(df),) + key
+  if key not in _cache:
+    _cache[key] = compute()
+    weakref.finalize(df, _cache.pop, key, None)
+
+  return _cache[key]
+
+# linear regression of y on x: slope, intercept, r_value, p_value, std_err; data is a dataframe or CrossStats
+def getRegression(df, x, y):
+  if isinstance(df, CrossStats):
+    return df.regression(x, y)
+
+  def compute():
+    set = df[[x, y]].dropna()
+    return tuple(stats.linregress(set[x], set[y]))
+
+  return cached(df, ("regression", x, y), compute)
+
+# corralation between bmi, sleeptime, physicalhealth, etc.
+def getCorrelationMatrix(df):
+  if isinstance(df, CrossStats):
+    return df.corr()
+
+  return cached(df, ("corr",), lambda: df[NUMERIC_COLUMNS].corr())
+
 # what correlations are there that results in a higher change of developing heart disease?
 # focus: bmi and sleeptime; does a person's bmi and hours of sleep impact the likelihood of developing heart disease?
 def getCorrelative(df, x, y):
-  set = df[["BMI", "SleepTime"]].dropna()
-  x = set["BMI"]
-  y = set["SleepTime"]
-
-  slope, intercept, r_value, p_value, std_err = stats.linregress(x, y)
+  slope, intercept, r_value, p_value, std_err = getRegression(df, x, y)
 
-  slop = round(slope, 2)
   intercept = round(intercept, 2)
 
-  x = np.linspace(28, 40)
-  y = x * slope + intercept
+  return slope, intercept
+
+# render figures without a display (e.g. in batch mode) so they can only be saved to files
+def useHeadless():
+  plt.switch_backend("Agg")
+
+# boxplot statistics (quartiles, 1.5 IQR whiskers, unique outliers) computed once, in the format of Axes.bxp
+def boxStats(values):
+  q1, med, q3 = np.percentile(values, [25, 50, 75])
+  iqr = q3 - q1
+  inside = values[(values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)]
+
+  return {"q1": q1, "med": med, "q3": q3, "whislo": inside.min(), "whishi": inside.max(),
+          "fliers": np.unique(values[(values < inside.min()) | (values > inside.max())])}
+
+# gaussian KDE (Scott's bandwidth, like seaborn) evaluated on a regular grid: the values are binned onto the grid and the
+# counts are convolved with the kernel through an FFT, which costs O(grid log grid) instead of O(values x grid)
+def binnedKde(values, low, high):
+  counts, edges = np.histogram(values, bins=KDE_GRID, range=(low, high))
+  grid = (edges[:-1] + edges[1:]) / 2
+  step = edges[1] - edges[0]
+  bandwidth = values.std(ddof=1) * len(values) ** (-1 / 5)
+
+  offsets = np.arange(-KDE_GRID, KDE_GRID + 1) * step
+  kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2) / (bandwidth * np.sqrt(2 * np.pi))
+  size = len(counts) + len(kernel) - 1
+  density = np.fft.irfft(np.fft.rfft(counts, size) * np.fft.rfft(kernel, size), size)[KDE_GRID:KDE_GRID + len(counts)]
+
+  return grid, density / len(values)
+
+# bxp takes orientation= since matplotlib 3.10 (vert= is deprecated there), and vert= before that
+HORIZONTAL_BXP = ({"orientation": "horizontal"} if "orientation" in inspect.signature(mpl.axes.Axes.bxp).parameters
+                  else {"vert": False})
+
+# draw a boxplot and a histogram with its KDE curve from precomputed summaries instead of the raw values, styled like
+# sns.boxplot and sns.histplot(kde=True)
+def drawBinned(values, ax_box, ax_hist, color):
+  values = np.asarray(values.dropna(), dtype="float64")
+  line = {"color": "0.3", "linewidth": 1}
+
+  # caps half as wide as the box, like sns.boxplot
+  ax_box.bxp([boxStats(values)], **HORIZONTAL_BXP, widths=0.8, capwidths=0.4, patch_artist=True,
+             boxprops={"facecolor": sns.desaturate(color, .75), "edgecolor": "0.3", "linewidth": 1},
+             whiskerprops=line, capprops=line, medianprops=line,
+             flierprops={"marker": "o", "markerfacecolor": "none", "markeredgecolor": "0.3", "markersize": 6})
+  ax_box.set(yticks=[])
+
+  counts, edges = np.histogram(values, bins="auto")
+  # the KDE line is drawn first so it comes first in the legend, like with seaborn
+  grid, density = binnedKde(values, edges[0], edges[-1])
+  ax_hist.plot(grid, density * len(values) * (edges[1] - edges[0]), color=color) # density scaled to the counts
+  ax_hist.bar(edges[:-1], counts, width=np.diff(edges), align="edge", color=color, alpha=0.5, edgecolor="white")
+  ax_hist.set(xlabel="BMI", ylabel="Count")
 
-  # corralation between bmi, sleeptime, physicalhealth, etc.
-  plt.figure(figsize=(12, 8))
-  corr = df.corr()
-  sns.heatmap(corr, annot=True)
+# build the correlation heatmap (Figure 1) and the BMI boxplots/histograms by heart disease (Figure 2); the figures
+# are only built when a plot is requested. With a prefix, the figures are saved as <prefix>_heatmap.png and
+# <prefix>_bmi.png and closed; otherwise they are returned for plt.show(). Above the threshold (or with binned=True),
+# Figure 2 is drawn from binned summaries (drawBinned) instead of passing every row to seaborn
+def plotCorrelative(df, prefix=None, binned=None, threshold=BINNED_THRESHOLD):
+  if binned is None:
+    binned = len(df) > threshold
+
+  heatmap = plt.figure(figsize=(12, 8))
+  sns.heatmap(getCorrelationMatrix(df), annot=True)
 
   sns.set(style="darkgrid")
   sns.set(rc={'figure.figsize':(12,8)})
@@ -70,11 +192,15 @@ def getCorrelative(df, x, y):
   f, (ax_box1, ax_box2, ax_hist) = plt.subplots(3, sharex=True, gridspec_kw={"height_ratios": (.15, .15, .85)})
   colours = ['#4285f4', '#ea4335', '#fbbc05', '#34a853']
   # assigning a graph to each axis
-  sns.boxplot(x=df[df['HeartDisease']=='Yes']["BMI"], ax=ax_box1, color="#ea4335")
-  sns.histplot(df[df['HeartDisease']=='Yes'], x="BMI", ax=ax_hist, kde=True, color="#ea4335")
+  if binned:
+    drawBinned(df[df['HeartDisease']]["BMI"], ax_box1, ax_hist, "#ea4335")
+    drawBinned(df[~df['HeartDisease']]["BMI"], ax_box2, ax_hist, '#4285f4')
+  else:
+    sns.boxplot(x=df[df['HeartDisease']]["BMI"], ax=ax_box1, color="#ea4335")
+    sns.histplot(df[df['HeartDisease']], x="BMI", ax=ax_hist, kde=True, color="#ea4335")
 
-  sns.boxplot(x=df[df['HeartDisease']=='No']["BMI"], ax=ax_box2, color='#4285f4')
-  sns.histplot(df[df['HeartDisease']=='No'], x="BMI", ax=ax_hist, kde=True, color='#4285f4')
+    sns.boxplot(x=df[~df['HeartDisease']]["BMI"], ax=ax_box2, color='#4285f4')
+    sns.histplot(df[~df['HeartDisease']], x="BMI", ax=ax_hist, kde=True, color='#4285f4')
 
   # Remove x axis name for the boxplots
   ax_box1.set(xlabel='')
@@ -82,7 +208,16 @@ def getCorrelative(df, x, y):
 
   plt.legend(title='', loc=2, labels=['Heart Disease', 'No HeartDisease'],bbox_to_anchor=(1.02, 1), borderaxespad=0.)
 
-  return slope, intercept
+  if prefix is None:
+    return heatmap, f
+
+  files = ["{}_heatmap.png".format(prefix), "{}_bmi.png".format(prefix)]
+  heatmap.savefig(files[0], bbox_inches="tight")
+  f.savefig(files[1], bbox_inches="tight")
+  plt.close(heatmap)
+  plt.close(f)
+
+  return files
 
 # calculate the rate of change, against a limit
 def getPredictive(df, slope, intercept):
@@ -108,19 +243,296 @@ def user_options():
 
   return option
 
-def main():
+# memory (bytes) of the dataset as read without declared dtypes: measured on the first chunk read that way, and scaled
+# up to all the rows
+def untypedMemory(path, rows, chunksize=CHUNK_ROWS):
+  sample = next(iter(pd.read_csv(path, chunksize=chunksize)))
+
+  return sample.memory_usage(deep=True).sum() * rows / len(sample)
+
+# convert AgeCategory column into mean ages; convert from categorical to continuous data through a lookup on the
+# category codes (code -1 is a missing value)
+def mapAgeCategory(df):
+  ages = df['AgeCategory'].cat
+  mean_ages = np.array([MEAN_AGE[category] for category in ages.categories] + [np.nan], dtype="float32")
+  df['AgeCategory'] = np.take(mean_ages, ages.codes)
+
+  return df
+
+# read the dataset with declared dtypes and convert the AgeCategory column into mean ages
+def loadData(path=DATA_FILE):
+  df = pd.read_csv(path, dtype=DTYPES, true_values=["Yes"], false_values=["No"])
+  before = untypedMemory(path, len(df))
+
+  df = mapAgeCategory(df)
+
+  after = df.memory_usage(deep=True).sum()
+  print("Memory: {:.1f} MB untyped, {:.1f} MB with declared dtypes.".format(before / 1e6, after / 1e6))
+
+  return df
+
+# read the dataset chunk by chunk, with the same dtypes and AgeCategory conversion as loadData; a Parquet file is
+# read whole (one survey file)
+def readChunks(path=DATA_FILE, chunksize=CHUNK_ROWS):
+  if path.endswith(".parquet"):
+    yield readFile(path)
+    return
+
+  for chunk in pd.read_csv(path, dtype=DTYPES, true_values=["Yes"], false_values=["No"], chunksize=chunksize):
+    yield mapAgeCategory(chunk)
+
+# read one csv or Parquet survey file with the declared dtypes and convert the AgeCategory column into mean ages
+def readFile(path):
+  if path.endswith(".parquet"):
+    df = pd.read_parquet(path)
+    for column in YES_NO_COLUMNS:
+      if df[column].dtype != "bool":
+        df[column] = df[column].map({"Yes": True, "No": False}).astype("bool")
+    df = df.astype({column: dtype for column, dtype in DTYPES.items() if column not in YES_NO_COLUMNS})
+  else:
+    df = pd.read_csv(path, dtype=DTYPES, true_values=["Yes"], false_values=["No"])
+
+  return mapAgeCategory(df)
+
+# the files matched by a glob pattern (e.g. one file per survey year or state), or the given list of files
+def findFiles(pattern):
+  if not isinstance(pattern, str):
+    return list(pattern)
+
+  return sorted(glob.glob(pattern)) or [pattern]
+
+# parse several csv/Parquet files concurrently in a process pool with the same dtypes, then concatenate them with the
+# categories of each categorical column unified (otherwise pandas falls back to object columns)
+def loadFiles(pattern, workers=None):
+  paths = findFiles(pattern)
+  if len(paths) == 1:
+    return readFile(paths[0])
+
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    frames = list(pool.map(readFile, paths))
+
+  for column in frames[0].select_dtypes(include="category").columns:
+    categories = pd.api.types.union_categoricals([frame[column] for frame in frames]).categories
+    for frame in frames:
+      frame[column] = frame[column].cat.set_categories(categories)
+
+  return pd.concat(frames, ignore_index=True)
+
+# map step of mapReduce: the statistics used by getSummary, getOutliers and getCorrelative for one file
+def fileStats(path):
+  return streamStats(path, correlate=True)
+
+# reduce step of mapReduce: merge the statistics of two files
+def mergeStats(left, right):
+  return left[0].merge(right[0]), left[1].merge(right[1])
+
+# run mapper on every file in a process pool and combine the per-file results with reducer; by default the result is
+# (RunningStats, CrossStats) over all files, which getSummary, getOutliers and getCorrelative accept
+def mapReduce(pattern, mapper=fileStats, reducer=mergeStats, workers=None):
+  paths = findFiles(pattern)
+  if len(paths) == 1:
+    return mapper(paths[0])
+
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    return reduce(reducer, pool.map(mapper, paths))
+
+# mergeable approximate quantile sketch (a simplified t-digest): the values are kept as at most `size` weighted
+# centroids, each the mean of an equal share of the sorted values seen so far
+class QuantileSketch:
+  def __init__(self, size=SKETCH_SIZE):
+    self.size = size
+    self.means = np.empty(0)
+    self.weights = np.empty(0)
+
+  def update(self, values):
+    self._add(np.asarray(values, dtype="float64"), np.ones(len(values)))
+    return self
+
+  def merge(self, other):
+    self._add(other.means, other.weights)
+    return self
+
+  def _add(self, means, weights):
+    means = np.concatenate([self.means, means])
+    weights = np.concatenate([self.weights, weights])
+    order = np.argsort(means, kind="stable")
+    means, weights = means[order], weights[order]
+
+    if len(means) > self.size:
+      # assign each centroid to an equal-weight bucket by its mid rank, then collapse the buckets
+      cumulative = np.cumsum(weights)
+      buckets = np.minimum((cumulative - weights / 2) / cumulative[-1] * self.size, self.size - 1).astype(int)
+      bucket_weights = np.bincount(buckets, weights, minlength=self.size)
+      bucket_sums = np.bincount(buckets, weights * means, minlength=self.size)
+      keep = bucket_weights > 0
+      means, weights = bucket_sums[keep] / bucket_weights[keep], bucket_weights[keep]
+
+    self.means, self.weights = means, weights
+
+  def quantile(self, q):
+    if not len(self.means):
+      return np.full(np.shape(q), np.nan)
+    ranks = np.cumsum(self.weights) - self.weights / 2
+    return np.interp(np.asarray(q) * self.weights.sum(), ranks, self.means)
+
+# one-pass accumulator of count, sum, min, max, mean and variance (Welford's update, in its chunked form by Chan et
+# al.) plus approximate quartiles for each numeric column; chunks are added with update() and partial results from
+# other chunks or files are combined with merge()
+class RunningStats:
+  def __init__(self, columns=NUMERIC_COLUMNS):
+    self.columns = list(columns)
+    self.count = np.zeros(len(self.columns))
+    self.sum = np.zeros(len(self.columns))
+    self.min = np.full(len(self.columns), np.inf)
+    self.max = np.full(len(self.columns), -np.inf)
+    self.mean = np.zeros(len(self.columns))
+    self.m2 = np.zeros(len(self.columns)) # sum of squared differences from the mean
+    self.sketches = [QuantileSketch() for column in self.columns]
+
+  def update(self, chunk):
+    values = chunk[self.columns].to_numpy(dtype="float64", na_value=np.nan)
+    present = ~np.isnan(values)
+    count = present.sum(axis=0)
+    total = np.where(present, values, 0).sum(axis=0)
+    mean = np.divide(total, count, out=np.zeros(len(self.columns)), where=count > 0)
+    m2 = np.where(present, (values - mean) ** 2, 0).sum(axis=0)
+
+    self._combine(count, total, np.where(present, values, np.inf).min(axis=0),
+                  np.where(present, values, -np.inf).max(axis=0), mean, m2)
+    for index, sketch in enumerate(self.sketches):
+      sketch.update(values[present[:, index], index])
+
+    return self
+
+  def merge(self, other):
+    self._combine(other.count, other.sum, other.min, other.max, other.mean, other.m2)
+    for sketch, other_sketch in zip(self.sketches, other.sketches):
+      sketch.merge(other_sketch)
+
+    return self
+
+  def _combine(self, count, total, min, max, mean, m2):
+    n = self.count + count
+    delta = mean - self.mean
+    share = np.divide(count, n, out=np.zeros(len(self.columns)), where=n > 0)
+
+    self.mean = self.mean + delta * share
+    self.m2 = self.m2 + m2 + delta ** 2 * self.count * share
+    self.count = n
+    self.sum = self.sum + total
+    self.min = np.minimum(self.min, min)
+    self.max = np.maximum(self.max, max)
+
+  def summary(self):
+    with np.errstate(invalid="ignore", divide="ignore"):
+      var = np.where(self.count > 1, self.m2 / (self.count - 1), np.nan)
+    quartiles = np.array([sketch.quantile([0.25, 0.5, 0.75]) for sketch in self.sketches]).reshape(-1, 3)
+    summary = pd.DataFrame({"count": self.count, "sum": self.sum, "min": self.min, "max": self.max,
+                            "mean": np.where(self.count > 0, self.mean, np.nan), "var": var, "std": np.sqrt(var),
+                            "25%": quartiles[:, 0], "50%": quartiles[:, 1], "75%": quartiles[:, 2]},
+                           index=pd.Index(self.columns, name="column"))
+
+    return summary
+
+# sufficient statistics for pairwise Pearson correlations and linear regressions, accumulated chunk by chunk: for
+# every pair of columns (i, j), over the rows where both are present, the count n[i, j], the sum of column i s[i, j],
+# its sum of squares ss[i, j] and the cross-product sum sp[i, j]. Values are shifted by the first chunk's means to
+# keep the sums of squares accurate. Partial results (other chunks or files) are combined with merge()
+class CrossStats:
+  def __init__(self, columns=NUMERIC_COLUMNS):
+    self.columns = list(columns)
+    self.shift = None
+
+  def _start(self, chunk):
+    size = len(self.columns)
+    self.shift = np.nan_to_num(chunk[self.columns].to_numpy(dtype="float64", na_value=np.nan).mean(axis=0))
+    self.n, self.s, self.ss, self.sp = (np.zeros((size, size)) for index in range(4))
+
+  def update(self, chunk):
+    if self.shift is None:
+      self._start(chunk)
+
+    values = chunk[self.columns].to_numpy(dtype="float64", na_value=np.nan) - self.shift
+    present = (~np.isnan(values)).astype("float64")
+    values = np.nan_to_num(values)
+
+    self.n += present.T @ present
+    self.s += values.T @ present
+    self.ss += (values ** 2).T @ present
+    self.sp += values.T @ values
+
+    return self
+
+  def merge(self, other):
+    if other.shift is None:
+      return self
+    if self.shift is None:
+      self.columns, self.shift = other.columns, other.shift.copy()
+      self.n, self.s, self.ss, self.sp = other.n.copy(), other.s.copy(), other.ss.copy(), other.sp.copy()
+      return self
+
+    # move the other sums onto this shift: x - shift = (x - other.shift) + d
+    d = other.shift - self.shift
+    di, dj = d[:, None], d[None, :]
+    self.sp += other.sp + other.s * dj + other.s.T * di + other.n * di * dj
+    self.ss += other.ss + 2 * other.s * di + other.n * di ** 2
+    self.s += other.s + other.n * di
+    self.n += other.n
+
+    return self
+
+  def _moments(self):
+    with np.errstate(invalid="ignore", divide="ignore"):
+      sxx = self.ss - self.s ** 2 / self.n # pairwise sum of squared deviations of column i
+      sxy = self.sp - self.s * self.s.T / self.n # pairwise sum of cross deviations
+    return sxx, sxy
+
+  def corr(self):
+    sxx, sxy = self._moments()
+    with np.errstate(invalid="ignore", divide="ignore"):
+      r = np.clip(sxy / np.sqrt(sxx * sxx.T), -1, 1)
+
+    return pd.DataFrame(r, index=self.columns, columns=self.columns)
+
+  # same results as stats.linregress(x, y) over the rows where both are present
+  def regression(self, x, y):
+    i, j = self.columns.index(x), self.columns.index(y)
+    sxx, sxy = self._moments()
+    n = self.n[i, j]
+
+    slope = sxy[i, j] / sxx[i, j]
+    intercept = (self.s[j, i] / n + self.shift[j]) - slope * (self.s[i, j] / n + self.shift[i])
+    r = np.clip(sxy[i, j] / np.sqrt(sxx[i, j] * sxx[j, i]), -1, 1)
+    df = n - 2
+    t = r * np.sqrt(df / ((1 - r) * (1 + r)))
+    p = 2 * stats.t.sf(np.abs(t), df)
+    std_err = np.sqrt((1 - r ** 2) * sxx[j, i] / sxx[i, j] / df)
+
+    return slope, intercept, r, p, std_err
+
+# statistics of a csv file computed chunk by chunk, without holding the file in memory; with correlate=True, the
+# CrossStats are accumulated in the same pass and (RunningStats, CrossStats) is returned
+def streamStats(path=DATA_FILE, chunksize=CHUNK_ROWS, correlate=False):
+  running, cross = RunningStats(), CrossStats()
+  for chunk in readChunks(path, chunksize):
+    running.update(chunk)
+    if correlate:
+      cross.update(chunk)
+
+  return (running, cross) if correlate else running
+
+# statistics of a dataframe (cached), or the RunningStats as is
+def getStats(data):
+  if isinstance(data, RunningStats):
+    return data
+
+  return cached(data, ("stats",), lambda: RunningStats().update(data))
+
+def main(path=DATA_FILE):
     print("Hi! Welcome to lab 4!\n")
     print("\n\tRetrieving data...\n")
 
-    df = pd.read_csv("lab04\heart_2020_cleaned.csv")
-    # convert AgeCategory column into mean ages; convert from categorical to continuous data
-    mean_age = {'55-59':57, '80 or older':80, '65-69':67,
-                      '75-79':77,'40-44':42,'70-74':72,'60-64':62,
-                      '50-54':52,'45-49':47,'18-24':21,'35-39':37,
-                      '30-34':32,'25-29':27}
-    df['AgeCategory'] = df['AgeCategory'].apply(lambda x: mean_age[x])
-    df['AgeCategory'] = df['AgeCategory'].astype('float')
-    slope, intercept = getCorrelative(df, "BMI", "SleepTime")
+    df = loadFiles(path) if len(findFiles(path)) > 1 else loadData(path)
 
     user = input("Would you like to run a function? (y/n): ")
     while (user.lower() == "yes" or user.lower() == "y"):
@@ -142,6 +554,8 @@ def main():
         sum, avg = getSummary(df, "BMI")
         print(f"The sum of all body mass indexes (BMI) is {sum} kg/m² and the average body mass index (BMI) is {avg} kg/m².")
       elif option == 3:
+        slope, intercept = getCorrelative(df, "BMI", "SleepTime")
+        plotCorrelative(df)
         if slope > 0:
           print("As an individual's body mass index (BMI) increases, the number of hours spent sleeping increases (Observe Figure 1).")
         elif slope < 0:
@@ -151,6 +565,7 @@ def main():
         print("Regardless, as an individual's body mass index (BMI) increases, the more likely they are found to have Heart Disease (Observe Figure 2).")
         plt.show()
       elif option == 4:
+        slope, intercept = getCorrelative(df, "BMI", "SleepTime")
         limit = getPredictive(df, slope, intercept)
         print(f"The rate of change of an individual's body mass index (BMI) with respect to the number of hours of sleep they get is roughly {slope} kg/m² per hour of sleep.")
       elif option == 5:
@@ -164,5 +579,90 @@ def main():
     print("\nThank you!")
 
 
+# run the menu options named in commands over one loaded dataset, without prompting; in stream mode df is the
+# RunningStats and cross the CrossStats of the streamed file
+def runCommands(df, commands, prefix="lab04", cross=None):
+  if cross is None:
+    cross = df
+
+  results = []
+
+  for command in commands:
+    if command == "outliers":
+      max, min = getOutliers(df, "BMI")
+      results.append((command, {"max": max, "min": min}))
+    elif command == "summary":
+      sum, avg = getSummary(df, "BMI")
+      results.append((command, {"sum": sum, "avg": avg}))
+    elif command in ("correlative", "predictive"):
+      slope, intercept = getCorrelative(cross, "BMI", "SleepTime")
+      if command == "correlative":
+        results.append((command, {"slope": slope, "intercept": intercept}))
+      else:
+        results.append((command, {"limit": getPredictive(df, slope, intercept), "slope": slope}))
+    elif command == "stats":
+      results.append((command, getStats(df).summary()))
+    elif command == "correlation":
+      results.append((command, getCorrelationMatrix(cross).rename_axis("column")))
+    elif command == "analysis":
+      results.append((command, dataAnalysis(df)))
+    elif command == "plot":
+      heatmap, bmi = plotCorrelative(df, prefix)
+      results.append((command, {"heatmap": heatmap, "bmi": bmi}))
+
+  return results
+
+# write command results as a json object keyed by command, or as one csv table with a leading command column
+def writeResults(results, format, outfile):
+  frames = []
+  for name, result in results:
+    frame = pd.DataFrame([result]) if isinstance(result, dict) else result.rename_axis(result.index.name or "statistic").reset_index()
+    frames.append((name, frame))
+
+  if format == "json":
+    payload = {name: json.loads(frame.to_json(orient="records")) for name, frame in frames}
+    json.dump(payload, outfile, indent=2)
+    outfile.write("\n")
+  else:
+    table = pd.concat([frame.assign(command=name) for name, frame in frames], ignore_index=True)
+    table = table[["command"] + [column for column in table.columns if column != "command"]]
+    table.to_csv(outfile, index=False, lineterminator="\n")
+
+# command line entry point: with commands, load the dataset once, run every command and write json/csv to stdout
+# (progress messages go to stderr); without commands, start the interactive menu
+def cli(argv=None):
+  parser = argparse.ArgumentParser(description="Lab 4: indicators of heart disease.")
+  parser.add_argument("commands", nargs="*", metavar="command", help="one or more of: {}".format(", ".join(COMMANDS)))
+  parser.add_argument("--file", default=DATA_FILE, help="heart disease csv/Parquet file, or a glob pattern of several files (quote it)")
+  parser.add_argument("--workers", type=int, help="processes used to read several files (default: one per core)")
+  parser.add_argument("--format", choices=["json", "csv"], default="json", help="output format (default: json)")
+  parser.add_argument("--stream", action="store_true", help="compute {} chunk by chunk without loading the file".format(", ".join(STREAM_COMMANDS)))
+  parser.add_argument("--prefix", default="lab04", help="file name prefix of the figures saved by plot (default: lab04)")
+  args = parser.parse_intermixed_args(argv) # commands may come before, between or after the options
+
+  unknown = [command for command in args.commands if command not in COMMANDS]
+  if unknown:
+    parser.error("unknown command(s): {}".format(", ".join(unknown)))
+  if args.stream and not set(args.commands) <= set(STREAM_COMMANDS):
+    parser.error("--stream only supports: {}".format(", ".join(STREAM_COMMANDS)))
+
+  if not args.commands:
+    main(args.file)
+    return 0
+
+  useHeadless()
+  outfile = sys.stdout
+  with redirect_stdout(sys.stderr):
+    multiple = len(findFiles(args.file)) > 1
+    if args.stream:
+      data, cross = mapReduce(args.file, workers=args.workers)
+    else:
+      data, cross = loadFiles(args.file, args.workers) if multiple else loadData(args.file), None
+    results = runCommands(data, args.commands, args.prefix, cross)
+
+  writeResults(results, args.format, outfile)
+
+  return 0
+
 if __name__=="__main__":
-  main()
+  sys.exit(cli())
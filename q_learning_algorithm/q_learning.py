@@ -2,7 +2,19 @@
 Reinforcement learning, Q-learning algorithm demo by Dr. Daniel Soper: https://youtu.be/iKdlKYG78j4
 '''
 #import libraries 
+import hashlib
+import importlib.machinery
+import importlib.util
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+import weakref
 import numpy as np 
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 
 #define the shape of the environment (i.e., its states)
 environment_rows = 11
@@ -47,42 +59,154 @@ aisles[8] = [3, 7]
 aisles[9] = [i for i in range(11)]
 
 '''
-set the rewards for all aisle locations (i.e., white squares)
+set the rewards for all aisle locations (i.e., white squares), all at once
 '''
-for row_index in range(1, 10):
-  for column_index in aisles[row_index]:
-    rewards[row_index, column_index] = -1.
+aisle_rows = np.repeat(list(aisles), [len(columns) for columns in aisles.values()])
+rewards[aisle_rows, np.concatenate(list(aisles.values()))] = -1.
   
 '''
-print rewards matrix
+compile the warehouse grid once into flat tables, so that moves and terminal checks are array lookups instead of
+string comparisons, and a whole batch of agents can be stepped with numpy array operations:
+state ids are int32 indexes, next_state[state, action] is the state reached by taking the action (moves off the grid
+stay in place), terminal[state] is 1 for terminal states (int8), and state_rewards holds the reward of each state
+(float32). cells[state] is the flat grid cell (row * columns + column) of each state, and cell_states[cell] the state
+of each cell (-1 if it has none).
+by default every cell is a state (so state ids are the flat cell indexes) and the terminal states are the cells whose
+reward is not -1; a terminal mask can be passed instead (e.g. for per-cell aisle rewards).
+with sparse=True only the cells an agent can ever be in are states: the non-terminal cells and the cells one move away
+from them. wall cells that are never visited get no state, so they take no space in the tables or the Q-table.
+the compiled tables can be saved to and loaded from a directory of .npy files, memory-mapped read-only by default, so
+that many processes share one copy from the page cache.
 '''
-print("\t\t\tRewards Matrix")
-for row in rewards:
-  print(row)
+class WarehouseEnvironment:
+  def __init__(self, rewards, terminal=None, sparse=False):
+    self.rows, self.columns = rewards.shape
+    cell_rewards = rewards.ravel()
+    #if the reward for a location is -1, then it is not a terminal state (i.e., it is a 'white square')
+    cell_terminal = cell_rewards != -1. if terminal is None else np.asarray(terminal, dtype=bool).ravel()
+    cell_next_state = self.build_transition_table()
+    if sparse:
+      open_cells = np.flatnonzero(~cell_terminal)
+      visited = np.zeros(len(cell_rewards), dtype=bool)
+      visited[open_cells] = True
+      visited[cell_next_state[open_cells]] = True
+      self.cells = np.flatnonzero(visited).astype(np.int64)
+    else:
+      self.cells = np.arange(len(cell_rewards), dtype=np.int64)
+    self.cell_states = np.full(len(cell_rewards), -1, dtype=np.int32)
+    self.cell_states[self.cells] = np.arange(len(self.cells))
+    self.n_states = len(self.cells)
+    self.state_rewards = cell_rewards[self.cells].astype(np.float32)
+    self.terminal = cell_terminal[self.cells].astype(np.int8)
+    self.next_state = self.cell_states[cell_next_state[self.cells]]
+    #terminal states never move, so their moves into cells without a state just stay in place
+    no_state = self.next_state < 0
+    self.next_state[no_state] = np.broadcast_to(np.arange(self.n_states, dtype=np.int32)[:, None], no_state.shape)[no_state]
+    self.starting_states = np.flatnonzero(self.terminal == 0).astype(np.int32)
+
+  @classmethod
+  def from_layout(cls, file, sparse=True):
+    return cls(*load_layout(file), sparse=sparse)
+
+  def build_transition_table(self):
+    #the transitions between grid cells
+    row_indexes, column_indexes = np.divmod(np.arange(self.rows * self.columns, dtype=np.int32), self.columns)
+    #one column per action: 0 = up, 1 = right, 2 = down, 3 = left
+    new_row_indexes = np.stack([np.maximum(row_indexes - 1, 0), row_indexes,
+                                np.minimum(row_indexes + 1, self.rows - 1), row_indexes], axis=1)
+    new_column_indexes = np.stack([column_indexes, np.minimum(column_indexes + 1, self.columns - 1),
+                                   column_indexes, np.maximum(column_indexes - 1, 0)], axis=1)
+    return (new_row_indexes * self.columns + new_column_indexes).astype(np.int32)
+
+  def state(self, row_index, column_index):
+    return self.cell_states[row_index * self.columns + column_index]
+
+  def location(self, state):
+    return divmod(int(self.cells[state]), self.columns)
+
+  TABLES = ['state_rewards', 'terminal', 'next_state', 'starting_states', 'cells', 'cell_states']
+
+  def save(self, directory):
+    os.makedirs(directory, exist_ok=True)
+    save_array(os.path.join(directory, 'shape.npy'), np.array([self.rows, self.columns]))
+    for name in self.TABLES:
+      save_array(os.path.join(directory, name + '.npy'), getattr(self, name))
+
+  @classmethod
+  def load(cls, directory, mmap_mode='r'):
+    #restore the compiled tables without compiling the grid again
+    environment = cls.__new__(cls)
+    environment.rows, environment.columns = (int(size) for size in np.load(os.path.join(directory, 'shape.npy')))
+    for name in cls.TABLES:
+      setattr(environment, name, np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode))
+    environment.n_states = len(environment.cells)
+    return environment
+
+  def same_layout(self, other):
+    return (self.rows, self.columns) == (other.rows, other.columns) and np.array_equal(self.cells, other.cells) and \
+           np.array_equal(self.state_rewards, other.state_rewards) and np.array_equal(self.terminal, other.terminal)
+
+'''
+define a warehouse layout loader. a layout is either an .npy file holding the reward of every cell, or a text file
+with one line per row of the grid, holding either whitespace separated rewards or one symbol per cell:
+'#' for a wall (reward -100), '.' for an aisle (reward -1), 'G' for a goal (reward 100; a layout can have several),
+or a digit 1-9 for an aisle with a higher cost (reward -digit, e.g. a congested aisle).
+walls (rewards of -100 or less) and goals (positive rewards) are terminal states, every other cell is an aisle.
+returns the rewards (float64) and the terminal mask of the grid.
+'''
+WALL_REWARD = -100.
+LAYOUT_SYMBOLS = {'#': WALL_REWARD, '.': -1., 'G': 100., **{str(digit): -float(digit) for digit in range(1, 10)}}
+
+def load_layout(file, symbols=LAYOUT_SYMBOLS):
+  if str(file).endswith('.npy'):
+    rewards = np.load(file).astype(np.float64)
+  else:
+    with open(file) as layout:
+      lines = [line.rstrip('\r\n') for line in layout if line.strip()]
+    if any(len(line.split()) > 1 for line in lines):
+      rewards = np.loadtxt(lines, ndmin=2)
+    else:
+      if len(set(map(len, lines))) > 1:
+        raise ValueError('all the rows of the layout must have the same width')
+      #map every symbol through a 256 entry lookup table at once
+      lookup = np.full(256, np.nan)
+      for symbol, reward in symbols.items():
+        lookup[ord(symbol)] = reward
+      codes = np.frombuffer(''.join(lines).encode('latin-1'), dtype=np.uint8).reshape(len(lines), -1)
+      rewards = lookup[codes]
+      if np.isnan(rewards).any():
+        raise ValueError('unknown layout symbols: {}'.format(
+          ''.join(sorted(set(bytes(codes[np.isnan(rewards)]).decode('latin-1'))))))
+  if rewards.ndim != 2:
+    raise ValueError('a layout must be a 2D grid')
+  return rewards, (rewards <= WALL_REWARD) | (rewards > 0)
+
+'''
+define a function that saves an array to an .npy file atomically (written to a temporary file, then renamed), so a
+process loading the file never sees it half written
+'''
+def save_array(file, array):
+  temporary_file = '{}.{}.tmp'.format(file, os.getpid())
+  with open(temporary_file, 'wb') as output:
+    np.save(output, array)
+  os.replace(temporary_file, file)
+
+environment = WarehouseEnvironment(rewards)
+#q_table is a (states, actions) view of q_values, so updating one updates the other
+q_table = q_values.reshape(environment.n_states, 4)
 
 '''
 define a function that determines if the specified location is a terminal state
 '''
 def is_terminal_state(current_row_index, current_column_index):
-  #if the reward for this location is -1, then it is not a terminal state (i.e., it is a 'white square')
-  if rewards[current_row_index, current_column_index] == -1.:
-    return False
-  else:
-    return True
+  return bool(environment.terminal[environment.state(current_row_index, current_column_index)])
 
 '''
 define a function that will choose a random, non-terminal starting location
 '''
 def get_starting_location():
-  #get a random row and column index
-  current_row_index = np.random.randint(environment_rows)
-  current_column_index = np.random.randint(environment_columns)
-  #continue choosing random row and column indexes until a non-terminal state is identified
-  #(i.e., until the chosen state is a 'white square').
-  while is_terminal_state(current_row_index, current_column_index):
-    current_row_index = np.random.randint(environment_rows)
-    current_column_index = np.random.randint(environment_columns)
-  return current_row_index, current_column_index
+  #choose among the non-terminal states (i.e., the 'white squares')
+  return environment.location(np.random.choice(environment.starting_states))
 
 '''
 define an epsilon greedy algorithm that will choose which action to take next (i.e., where to move next)
@@ -99,80 +223,921 @@ def get_next_action(current_row_index, current_column_index, epsilon):
 define a function that will get the next location based on the chosen action
 '''
 def get_next_location(current_row_index, current_column_index, action_index):
-  new_row_index = current_row_index
-  new_column_index = current_column_index
-  if actions[action_index] == 'up' and current_row_index > 0:
-    new_row_index -= 1
-  elif actions[action_index] == 'right' and current_column_index < environment_columns - 1:
-    new_column_index += 1
-  elif actions[action_index] == 'down' and current_row_index < environment_rows - 1:
-    new_row_index += 1
-  elif actions[action_index] == 'left' and current_column_index > 0:
-    new_column_index -= 1
-  return new_row_index, new_column_index
+  return environment.location(environment.next_state[environment.state(current_row_index, current_column_index), action_index])
+
+'''
+since the rewards and the transitions are fully known, the optimal policy can also be solved for directly instead of
+learned. the solvers below return a next-hop table: next_action[state] is the optimal action in that state, or -1 for
+terminal states and states from which no goal (a terminal state with a positive reward) can be reached.
+'''
+
+'''
+define a function that follows a next-hop table from every state at once and returns the state each walk ends in.
+the next states are followed with pointer jumping (each pass doubles the number of steps followed), so this costs
+O(states * log(states)) instead of walking every path. terminal states (and states without a next hop, -1) stay where
+they are, so a walk that ends in a non-terminal state is caught in a cycle.
+'''
+def follow_next_hops(environment, next_action):
+  hops = environment.next_state[np.arange(environment.n_states), np.maximum(next_action, 0)]
+  stay = (environment.terminal == 1) | (next_action < 0)
+  hops[stay] = np.flatnonzero(stay)
+  for jump in range(int(np.ceil(np.log2(max(environment.n_states, 2))))):
+    hops = hops[hops]
+  return hops
+
+def goal_states(environment):
+  return (environment.terminal == 1) & (environment.state_rewards > 0)
+
+'''
+define a vectorized value iteration over the whole grid: Q(s, a) = R(s') + discount_factor * V(s'), where V is 0 for
+terminal states and max_a Q(s, a) otherwise, the same target the Q-learning update converges to.
+returns the next-hop table and the optimal Q-table.
+'''
+def value_iteration(environment, discount_factor=0.9, tolerance=1e-12, max_iterations=100000):
+  state_rewards = environment.state_rewards.astype(np.float64)
+  non_terminal = environment.terminal == 0
+  values = np.zeros(environment.n_states)
+  move_rewards = state_rewards[environment.next_state]
+  for iteration in range(max_iterations):
+    optimal_q = move_rewards + discount_factor * values[environment.next_state]
+    new_values = np.where(non_terminal, optimal_q.max(axis=1), 0.)
+    change = np.abs(new_values - values).max()
+    values = new_values
+    if change <= tolerance:
+      break
+  optimal_q = move_rewards + discount_factor * values[environment.next_state]
+  optimal_q[~non_terminal] = 0.
+  next_action = np.where(non_terminal, optimal_q.argmax(axis=1), -1).astype(np.int8)
+
+  #a state reaches a goal if following the next hops leads to a goal
+  next_action[~goal_states(environment)[follow_next_hops(environment, next_action)]] = -1
+  return next_action, optimal_q
+
+'''
+define a function that returns the reversed transition graph in compressed sparse row form:
+predecessors[pointers[t]:pointers[t + 1]] are the non-terminal states that move to state t
+'''
+def reversed_graph(environment):
+  sources = np.repeat(np.arange(environment.n_states, dtype=np.int32), 4)
+  targets = environment.next_state.ravel()
+  keep = (environment.terminal[sources] == 0) & (sources != targets)
+  sources, targets = sources[keep], targets[keep]
+  order = np.argsort(targets, kind='stable')
+  return sources[order], np.searchsorted(targets[order], np.arange(environment.n_states + 1))
+
+#gather the predecessors of a whole frontier at once (and how many each frontier state has)
+def gather_predecessors(predecessors, pointers, frontier):
+  counts = pointers[frontier + 1] - pointers[frontier]
+  offsets = np.repeat(pointers[frontier] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+  return predecessors[offsets], counts
+
+'''
+define a multi-source breadth first search backwards from every goal state, on the reversed transition graph.
+every move costs the same, so the BFS distance is the fewest number of moves to the nearest goal (-1 if unreachable).
+returns the next-hop table and the distances.
+'''
+def breadth_first_search(environment):
+  predecessors, pointers = reversed_graph(environment)
+  distances = np.full(environment.n_states, -1, dtype=np.int32)
+  frontier = np.flatnonzero(goal_states(environment))
+  distances[frontier] = 0
+  distance = 0
+  while len(frontier):
+    candidates = gather_predecessors(predecessors, pointers, frontier)[0]
+    frontier = np.unique(candidates[distances[candidates] == -1])
+    distance += 1
+    distances[frontier] = distance
+
+  #the next hop is the first action that moves one step closer to a goal
+  closer = (distances[environment.next_state] == distances[:, None] - 1) & (distances[:, None] > 0)
+  next_action = np.where(closer.any(axis=1), closer.argmax(axis=1), -1).astype(np.int8)
+  return next_action, distances
+
+'''
+define a multi-source least cost search backwards from every goal state, for layouts where aisles cost different
+amounts: a move costs minus the reward of the aisle it leaves. the cost of a state is the cheapest total cost to the
+nearest goal (inf if unreachable), the same costs Dijkstra's algorithm finds; with every aisle at -1 it is the BFS
+distance. the search is label correcting: every pass offers the cost of the states that
+got cheaper to all their predecessors at once, until no state gets cheaper.
+returns the next-hop table, the costs, and the cost of a move out of each state.
+'''
+def least_cost_search(environment):
+  predecessors, pointers = reversed_graph(environment)
+  move_costs = np.where(environment.terminal == 0, np.maximum(-environment.state_rewards.astype(np.float64), 0.), 0.)
+  costs = np.full(environment.n_states, np.inf)
+  frontier = np.flatnonzero(goal_states(environment))
+  costs[frontier] = 0.
+  while len(frontier):
+    candidates, counts = gather_predecessors(predecessors, pointers, frontier)
+    offers = np.repeat(costs[frontier], counts) + move_costs[candidates]
+    #keep the cheapest offer to every candidate
+    order = np.lexsort((offers, candidates))
+    candidates, offers = candidates[order], offers[order]
+    first = np.ones(len(candidates), dtype=bool)
+    first[1:] = candidates[1:] != candidates[:-1]
+    candidates, offers = candidates[first], offers[first]
+    cheaper = offers < costs[candidates]
+    frontier = candidates[cheaper]
+    costs[frontier] = offers[cheaper]
+
+  #the next hop is the first action whose move cost plus the cost of the next state is the cost of the state
+  cheapest = cheapest_moves(environment, costs, move_costs) & (environment.terminal == 0)[:, None]
+  next_action = np.where(cheapest.any(axis=1), cheapest.argmax(axis=1), -1).astype(np.int8)
+  return next_action, costs, move_costs
+
+#which moves of every state are on a cheapest path (up to rounding of the summed costs); moves that stay in place never
+#are, so free aisles (reward 0) cannot trap a path
+def cheapest_moves(environment, costs, move_costs):
+  offers = move_costs[:, None] + costs[environment.next_state]
+  moves = environment.next_state != np.arange(environment.n_states)[:, None]
+  return moves & np.isfinite(costs)[:, None] & (offers <= costs[:, None] + 1e-9 * np.maximum(costs[:, None], 1.))
+
+SOLVERS = {'value_iteration': lambda environment, discount_factor: value_iteration(environment, discount_factor)[0],
+           'bfs': lambda environment, discount_factor: breadth_first_search(environment)[0],
+           'least_cost': lambda environment, discount_factor: least_cost_search(environment)[0]}
+
+'''
+define a function that returns the next-hop table of a solver, solving the environment only once per solver
+'''
+def get_next_hops(environment, solver='bfs', discount_factor=0.9):
+  next_hops = environment.__dict__.setdefault('next_hops', {})
+  key = (solver, discount_factor)
+  if key not in next_hops:
+    next_hops[key] = SOLVERS[solver](environment, discount_factor)
+  return next_hops[key]
+
+'''
+greedy next-hop tables of learned Q-tables are cached per (Q-table, environment), keyed by the array that owns the
+Q-table's memory (so q_values and its q_table view share one entry), and dropped when that array is freed. a cached
+table is only reused while a hash of the Q-table's contents is unchanged, so any change to the Q-table (by training,
+or by hand) invalidates it; hashing costs about as much as one argmax over the table.
+'''
+greedy_next_hops = {}
+
+def owner(array):
+  while isinstance(array.base, np.ndarray):
+    array = array.base
+  return array
+
+def fingerprint(q_table):
+  return hashlib.blake2b(np.ascontiguousarray(q_table)).digest()
+
+def forget_q_table(key):
+  greedy_next_hops.pop(key, None)
+
+'''
+define a function that returns the greedy next-hop table of a Q-table (the argmax of every state, computed once until
+the Q-table changes), with -1 for states whose greedy path does not end on a goal: it is caught in a cycle, or walks
+into a wall
+'''
+def get_greedy_next_hops(environment, q_table):
+  array = owner(q_table)
+  key = id(array)
+  contents = fingerprint(q_table)
+  entry = greedy_next_hops.get(key, {})
+  cached = entry.get(id(environment))
+  if cached is not None and cached[0]() is array and cached[1]() is environment and cached[2] == contents:
+    return cached[3]
+  next_action = np.asarray(q_table).reshape(environment.n_states, 4).argmax(axis=1).astype(np.int8)
+  #a walk that ends in a non-terminal state is caught in a cycle, and one that ends in a wall found no goal
+  next_action[~goal_states(environment)[follow_next_hops(environment, next_action)]] = -1
+  if not entry:
+    weakref.finalize(array, forget_q_table, key)
+  entry[id(environment)] = (weakref.ref(array), weakref.ref(environment), contents, next_action)
+  greedy_next_hops[key] = entry
+  return next_action
+
+'''
+define a function that will get the shortest paths between an array of start locations (rows of [row, column]) and the
+item packaging location, all at once: every step moves all the unfinished paths together.
+by default the paths follow the learned Q-table (its cached greedy next-hop table, recomputed whenever the Q-table's
+contents change); with solver='bfs', solver='least_cost' (for aisles with different costs) or
+solver='value_iteration' they follow the exact next-hop table instead.
+paths that start on a terminal state, do not end on a goal (a greedy cycle or a walk into a wall), or take more than
+max_steps moves (by default the number of states) are empty. with encoded=True the paths are returned compactly
+instead, as (start_states, lengths, moves): the flat start state of each path, its number of moves (-1 for no path),
+and the action codes of all the moves of all the paths concatenated (uint8); see decode_path.
+'''
+def get_shortest_paths(start_locations, environment=environment, q_table=q_table, solver=None, max_steps=None,
+                       encoded=False):
+  start_locations = np.asarray(start_locations, dtype=np.int64).reshape(-1, 2)
+  start_states = environment.state(start_locations[:, 0], start_locations[:, 1])
+  next_action = get_greedy_next_hops(environment, q_table) if solver is None else get_next_hops(environment, solver)
+  max_steps = environment.n_states if max_steps is None else max_steps
+
+  #cells without a state (walls that are never visited) are invalid starting locations too
+  has_state = start_states >= 0
+  lengths = np.where(has_state & (environment.terminal[start_states] == 0) & (next_action[start_states] >= 0), 0, -1)
+  active = np.flatnonzero(lengths == 0)
+  states = start_states[active]
+  path_indexes, path_actions, path_states = [], [], []
+  for step in range(max_steps):
+    if not len(active):
+      break
+    actions = next_action[states]
+    states = environment.next_state[states, actions]
+    path_indexes.append(active)
+    path_actions.append(actions)
+    path_states.append(states)
+    lengths[active] += 1
+    unfinished = environment.terminal[states] == 0
+    active, states = active[unfinished], states[unfinished]
+  lengths[active] = -1 #too many moves
+
+  #group the moves by path, in step order, dropping the moves of paths that ran out of steps
+  path_indexes = np.concatenate(path_indexes) if path_indexes else np.zeros(0, dtype=np.int64)
+  order = np.argsort(path_indexes, kind='stable')
+  order = order[lengths[path_indexes[order]] > 0]
+  if encoded:
+    actions = np.concatenate(path_actions)[order] if path_actions else np.zeros(0)
+    return start_states, lengths, actions.astype(np.uint8)
+
+  rows, columns = np.divmod(environment.cells[np.concatenate(path_states)[order]] if path_states
+                            else np.zeros(0, dtype=np.int64), environment.columns)
+  locations = np.stack([rows, columns], axis=1).tolist()
+  paths, position = [], 0
+  for start_location, length in zip(start_locations.tolist(), lengths.tolist()):
+    if length < 0:
+      paths.append([])
+    else:
+      paths.append([start_location] + locations[position:position + length])
+      position += length
+  return paths
+
+'''
+define a function that decodes a compact path (a flat start state and its move codes) back into a list of locations
+'''
+def decode_path(start_state, moves, environment=environment):
+  states = [int(start_state)]
+  for action in moves:
+    states.append(int(environment.next_state[states[-1], action]))
+  return [list(environment.location(state)) for state in states]
 
 '''
 define a function that will get the shortest path between any location within the warehouse that 
 the robot is allowed to travel and the item packaging location.
+by default the path follows the learned Q-table; with solver='bfs', solver='least_cost' or solver='value_iteration' it
+follows the exact next-hop table instead. the path is empty if the location is invalid or the greedy policy never
+reaches the goal.
+'''
+def get_shortest_path(start_row_index, start_column_index, environment=environment, q_table=q_table, solver=None):
+  return get_shortest_paths([[start_row_index, start_column_index]], environment, q_table, solver)[0]
+
+'''
+define a check that the learned Q-policy agrees with the exact one: returns the starting states that can reach a goal
+but whose greedy action is not on a cheapest path to one (an empty array if the learned policy is optimal everywhere).
+the exact costs come from the least cost search, so aisles with different costs are taken into account.
+'''
+def check_policy(environment, q_table):
+  costs, move_costs = least_cost_search(environment)[1:]
+  states = environment.starting_states[np.isfinite(costs[environment.starting_states])]
+  greedy_actions = np.argmax(q_table[states], axis=1)
+  return states[~cheapest_moves(environment, costs, move_costs)[states, greedy_actions]]
+
 '''
-def get_shortest_path(start_row_index, start_column_index):
-  #return immediately if this is an invalid starting location
-  if is_terminal_state(start_row_index, start_column_index):
-    return []
-  else: #if this is a 'legal' starting location
-    current_row_index, current_column_index = start_row_index, start_column_index
-    shortest_path = []
-    shortest_path.append([current_row_index, current_column_index])
-    #continue moving along the path until we reach the goal (i.e., the item packaging location)
-    while not is_terminal_state(current_row_index, current_column_index):
-      #get the best action to take
-      action_index = get_next_action(current_row_index, current_column_index, 1.)
-      #move to the next location on the path, and add the new location to the list
-      current_row_index, current_column_index = get_next_location(current_row_index, current_column_index, action_index)
-      shortest_path.append([current_row_index, current_column_index])
-    return shortest_path
-
-    #define training parameters
-epsilon = 0.9 #the percentage of time when we should take the best action (instead of a random action)
-discount_factor = 0.9 #discount factor for future rewards
-learning_rate = 0.9 #the rate at which the AI agent should learn
-
-#run through 1000 training episodes
-for episode in range(1000):
-  #get the starting location for this episode
-  row_index, column_index = get_starting_location()
-
-  #continue taking actions (i.e., moving) until we reach a terminal state
-  #(i.e., until we reach the item packaging area or crash into an item storage location)
-  while not is_terminal_state(row_index, column_index):
-    #choose which action to take (i.e., where to move next)
-    action_index = get_next_action(row_index, column_index, epsilon)
-
-    #perform the chosen action, and transition to the next state (i.e., move to the next location)
-    old_row_index, old_column_index = row_index, column_index #store the old row and column indexes
-    row_index, column_index = get_next_location(row_index, column_index, action_index)
-    
-    #receive the reward for moving to the new state, and calculate the temporal difference
-    reward = rewards[row_index, column_index]
-    old_q_value = q_values[old_row_index, old_column_index, action_index]
-    temporal_difference = reward + (discount_factor * np.max(q_values[row_index, column_index])) - old_q_value
-
-    #update the Q-value for the previous state and action pair
-    new_q_value = old_q_value + (learning_rate * temporal_difference)
-    q_values[old_row_index, old_column_index, action_index] = new_q_value
-
-print('Training complete!')
-
-#display a few shortest paths
-print("\t\t\tShortest path from (3,9)")
-print(get_shortest_path(3, 9)) #starting at row 3, column 9
-print("\t\t\tShortest path from (5,0)")
-print(get_shortest_path(5, 0)) #starting at row 5, column 0
-print("\t\t\tShortest path from (9,5)")
-print(get_shortest_path(9, 5)) #starting at row 9, column 5
-
-#display an example of reversed shortest path
-print("\t\t\tReverse shortest path from (0,5) to (5,2)")
-path = get_shortest_path(5, 2) #go to row 5, column 2
-path.reverse()
-print(path)
\ No newline at end of file
+define a batched training loop that steps n_agents independent agents at once, for a total of `episodes` episodes
+(an agent that reaches a terminal state starts a new episode while episodes are left).
+agents that update the same (state, action) pair in the same step have their temporal differences averaged,
+so colliding updates are applied once instead of overwriting each other.
+returns the length and the largest absolute temporal difference of every episode, in the order they finished.
+'''
+def train_batched(environment, q_table, episodes, n_agents, epsilon, discount_factor, learning_rate, rng=None):
+  rng = np.random.default_rng() if rng is None else rng
+
+  n_agents = min(n_agents, episodes)
+  states = rng.choice(environment.starting_states, n_agents)
+  episodes_left = episodes - n_agents
+  #per agent telemetry of the running episodes, and of the finished ones
+  lengths, max_differences = np.zeros(n_agents, dtype=np.int64), np.zeros(n_agents)
+  episode_lengths, episode_max_differences = [], []
+
+  while len(states):
+    #epsilon greedy actions for the whole batch
+    greedy_actions = q_table[states].argmax(axis=1)
+    random_actions = rng.integers(4, size=len(states))
+    actions = np.where(rng.random(len(states)) < epsilon, greedy_actions, random_actions)
+
+    #move every agent and calculate the temporal differences
+    new_states = environment.next_state[states, actions]
+    temporal_differences = (environment.state_rewards[new_states] + discount_factor * q_table[new_states].max(axis=1)
+                            - q_table[states, actions])
+
+    #average the temporal differences of colliding (state, action) pairs, then update the Q-values
+    pairs = states * 4 + actions
+    unique_pairs, inverse, counts = np.unique(pairs, return_inverse=True, return_counts=True)
+    mean_differences = np.bincount(inverse, temporal_differences) / counts
+    q_table.flat[unique_pairs] += learning_rate * mean_differences
+    lengths += 1
+    np.maximum(max_differences, np.abs(temporal_differences), out=max_differences)
+
+    #agents in a terminal state start a new episode while episodes are left, the others stop
+    states = new_states
+    done = np.flatnonzero(environment.terminal[states])
+    episode_lengths.append(lengths[done])
+    episode_max_differences.append(max_differences[done])
+    restarts = done[:episodes_left]
+    states[restarts] = rng.choice(environment.starting_states, len(restarts))
+    lengths[restarts], max_differences[restarts] = 0, 0.
+    episodes_left -= len(restarts)
+    stops = done[len(restarts):]
+    states, lengths, max_differences = (np.delete(values, stops) for values in (states, lengths, max_differences))
+  return np.concatenate(episode_lengths), np.concatenate(episode_max_differences)
+
+'''
+pluggable backends for the sequential (one agent) training loop. every backend runs whole episodes over the compiled
+tables with the same seeded random number generator (splitmix64) and the same order of floating point operations,
+so all backends produce bit-for-bit the same Q-table as the reference 'python' backend for the same seed.
+the generator state is passed in and out as a one element uint64 array (rng_state), so training in several calls
+continues one random stream and gives the same Q-table as training in one call.
+every backend also fills in the length and the largest absolute temporal difference of each episode.
+available backends: 'python' (reference, always available), 'numba' (if numba is installed) and 'cffi' (a C kernel
+compiled with cffi, if cffi and a C compiler are available).
+'''
+MASK_64 = 0xFFFFFFFFFFFFFFFF
+
+def run_episodes_python(next_state, terminal, state_rewards, starting_states, q_table, episodes, rng_state,
+                        epsilon, discount_factor, learning_rate, episode_lengths, max_differences):
+  #plain python lists are much faster to index one element at a time than numpy arrays
+  next_state, terminal, state_rewards = next_state.tolist(), terminal.tolist(), state_rewards.tolist()
+  starting_states, q = starting_states.tolist(), q_table.ravel().tolist()
+  rng = int(rng_state[0])
+  steps = 0
+
+  def next_random():
+    nonlocal rng
+    rng = (rng + 0x9E3779B97F4A7C15) & MASK_64
+    z = rng
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return z ^ (z >> 31)
+
+  lengths, differences = [0] * episodes, [0.] * episodes
+  for episode in range(episodes):
+    state = starting_states[next_random() % len(starting_states)]
+    length, max_difference = 0, 0.
+    while not terminal[state]:
+      #epsilon greedy action: the first best action, or a random one
+      if (next_random() >> 11) * (1.0 / 9007199254740992.0) < epsilon:
+        action = 0
+        for candidate in range(1, 4):
+          if q[state * 4 + candidate] > q[state * 4 + action]:
+            action = candidate
+      else:
+        action = next_random() % 4
+      new_state = next_state[state][action]
+      best = max(q[new_state * 4:new_state * 4 + 4])
+      old_q_value = q[state * 4 + action]
+      temporal_difference = state_rewards[new_state] + discount_factor * best - old_q_value
+      q[state * 4 + action] = old_q_value + learning_rate * temporal_difference
+      max_difference = max(max_difference, abs(temporal_difference))
+      state = new_state
+      length += 1
+    lengths[episode], differences[episode] = length, max_difference
+    steps += length
+
+  q_table.ravel()[:] = q
+  episode_lengths[:], max_differences[:] = lengths, differences
+  rng_state[0] = rng
+  return steps
+
+def build_numba_kernel():
+  from numba import njit
+
+  @njit(cache=False)
+  def next_random(rng):
+    rng[0] += np.uint64(0x9E3779B97F4A7C15)
+    z = rng[0]
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+  @njit(cache=False)
+  def run_episodes(next_state, terminal, state_rewards, starting_states, q, episodes, rng,
+                   epsilon, discount_factor, learning_rate, episode_lengths, max_differences):
+    steps = 0
+    for episode in range(episodes):
+      state = np.int64(starting_states[np.int64(next_random(rng) % np.uint64(len(starting_states)))])
+      length, max_difference = 0, 0.
+      while not terminal[state]:
+        if (next_random(rng) >> np.uint64(11)) * (1.0 / 9007199254740992.0) < epsilon:
+          action = np.int64(0)
+          for candidate in range(1, 4):
+            if q[state * 4 + candidate] > q[state * 4 + action]:
+              action = candidate
+        else:
+          action = np.int64(next_random(rng) % np.uint64(4))
+        new_state = np.int64(next_state[state, action])
+        best = q[new_state * 4]
+        for candidate in range(1, 4):
+          if q[new_state * 4 + candidate] > best:
+            best = q[new_state * 4 + candidate]
+        old_q_value = q[state * 4 + action]
+        temporal_difference = state_rewards[new_state] + discount_factor * best - old_q_value
+        q[state * 4 + action] = old_q_value + learning_rate * temporal_difference
+        max_difference = max(max_difference, abs(temporal_difference))
+        state = new_state
+        length += 1
+      episode_lengths[episode], max_differences[episode] = length, max_difference
+      steps += length
+    return steps
+
+  def run_episodes_numba(next_state, terminal, state_rewards, starting_states, q_table, episodes, rng_state,
+                         epsilon, discount_factor, learning_rate, episode_lengths, max_differences):
+    q = q_table.reshape(-1) #a view, updated in place
+    return int(run_episodes(next_state, terminal, state_rewards, starting_states, q, episodes, rng_state,
+                            epsilon, discount_factor, learning_rate, episode_lengths, max_differences))
+
+  return run_episodes_numba
+
+CFFI_DECLARATIONS = '''
+long long run_episodes(const int32_t *next_state, const int8_t *terminal, const double *state_rewards,
+                       const int32_t *starting_states, long long n_starting_states, double *q, long long episodes,
+                       uint64_t *rng_state, double epsilon, double discount_factor, double learning_rate,
+                       long long *episode_lengths, double *max_differences);
+'''
+
+CFFI_SOURCE = '''
+#include <math.h>
+#include <stdint.h>
+
+static uint64_t next_random(uint64_t *rng) {
+  uint64_t z = (*rng += 0x9E3779B97F4A7C15ULL);
+  z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+  z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+  return z ^ (z >> 31);
+}
+
+long long run_episodes(const int32_t *next_state, const int8_t *terminal, const double *state_rewards,
+                       const int32_t *starting_states, long long n_starting_states, double *q, long long episodes,
+                       uint64_t *rng_state, double epsilon, double discount_factor, double learning_rate,
+                       long long *episode_lengths, double *max_differences) {
+  uint64_t rng = *rng_state;
+  long long steps = 0;
+  for (long long episode = 0; episode < episodes; episode++) {
+    int32_t state = starting_states[next_random(&rng) % (uint64_t)n_starting_states];
+    long long length = 0;
+    double max_difference = 0.0;
+    while (!terminal[state]) {
+      int action = 0;
+      if ((double)(next_random(&rng) >> 11) * (1.0 / 9007199254740992.0) < epsilon) {
+        for (int candidate = 1; candidate < 4; candidate++)
+          if (q[state * 4 + candidate] > q[state * 4 + action]) action = candidate;
+      } else {
+        action = (int)(next_random(&rng) % 4);
+      }
+      int32_t new_state = next_state[state * 4 + action];
+      double best = q[new_state * 4];
+      for (int candidate = 1; candidate < 4; candidate++)
+        if (q[new_state * 4 + candidate] > best) best = q[new_state * 4 + candidate];
+      double old_q_value = q[state * 4 + action];
+      double temporal_difference = state_rewards[new_state] + discount_factor * best - old_q_value;
+      q[state * 4 + action] = old_q_value + learning_rate * temporal_difference;
+      if (fabs(temporal_difference) > max_difference) max_difference = fabs(temporal_difference);
+      state = new_state;
+      length++;
+    }
+    episode_lengths[episode] = length;
+    max_differences[episode] = max_difference;
+    steps += length;
+  }
+  *rng_state = rng;
+  return steps;
+}
+'''
+
+#no fused multiply-add contraction, so the results match the other backends bit for bit
+CFFI_COMPILE_ARGS = ['-O2', '-ffp-contract=off']
+
+class BackendUnavailable(Exception):
+  pass
+
+'''
+define a function that checks that a cached file or directory can be trusted before a library is loaded from it: it must
+be owned by the current user and not writable by anyone else (otherwise another user could plant code in it)
+'''
+def check_private(path):
+  if not hasattr(os, 'getuid'): #no owners or permission bits to check (windows)
+    return
+  status = os.lstat(path)
+  if status.st_uid != os.getuid() or status.st_mode & 0o022:
+    raise BackendUnavailable('refusing to load the kernel: {} is not private to the current user'.format(path))
+
+'''
+define a function that builds the C kernel with cffi, once per user: the compiled library is cached in a private
+directory of the user's cache directory (~/.cache/q_learning, or $XDG_CACHE_HOME/q_learning; created with mode 0o700),
+named after a hash of the kernel source, and processes that find it there (e.g. sweep workers) load it without
+compiling. every build happens in its own temporary directory, which is removed afterwards, and the library is moved
+into the cache atomically, so concurrent builds never see a half written file. a cache that is not owned by the user,
+or writable by others, is refused.
+'''
+def build_cffi_kernel():
+  import cffi
+
+  key = hashlib.sha256('\0'.join([CFFI_DECLARATIONS, CFFI_SOURCE] + CFFI_COMPILE_ARGS).encode()).hexdigest()[:16]
+  cache_root = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache')),
+                            'q_learning')
+  cache_directory = os.path.join(cache_root, 'kernel_' + key)
+  library_path = os.path.join(cache_directory, '_q_learning_kernel' + importlib.machinery.EXTENSION_SUFFIXES[0])
+  os.makedirs(cache_directory, mode=0o700, exist_ok=True)
+  for path in [cache_root, cache_directory]:
+    check_private(path)
+  if not os.path.exists(library_path):
+    ffi = cffi.FFI()
+    ffi.cdef(CFFI_DECLARATIONS)
+    ffi.set_source('_q_learning_kernel', CFFI_SOURCE, extra_compile_args=CFFI_COMPILE_ARGS)
+    build_directory = tempfile.mkdtemp(dir=cache_directory)
+    try:
+      os.replace(ffi.compile(tmpdir=build_directory, verbose=False), library_path)
+    except cffi.VerificationError as error: #no C compiler, or it failed
+      raise BackendUnavailable(str(error)) from error
+    finally:
+      shutil.rmtree(build_directory, ignore_errors=True)
+  check_private(library_path)
+  spec = importlib.util.spec_from_file_location('_q_learning_kernel', library_path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+
+  def run_episodes_cffi(next_state, terminal, state_rewards, starting_states, q_table, episodes, rng_state,
+                        epsilon, discount_factor, learning_rate, episode_lengths, max_differences):
+    q = q_table.reshape(-1) #a view, updated in place
+    return module.lib.run_episodes(module.ffi.from_buffer('int32_t[]', next_state),
+                                   module.ffi.from_buffer('int8_t[]', terminal),
+                                   module.ffi.from_buffer('double[]', state_rewards),
+                                   module.ffi.from_buffer('int32_t[]', starting_states), len(starting_states),
+                                   module.ffi.from_buffer('double[]', q), episodes,
+                                   module.ffi.from_buffer('uint64_t[]', rng_state),
+                                   epsilon, discount_factor, learning_rate,
+                                   module.ffi.from_buffer('long long[]', episode_lengths),
+                                   module.ffi.from_buffer('double[]', max_differences))
+
+  return run_episodes_cffi
+
+BACKEND_BUILDERS = {'python': lambda: run_episodes_python, 'numba': build_numba_kernel, 'cffi': build_cffi_kernel}
+backends = {} #backends that were built successfully
+
+'''
+define a function that returns the training kernel of a backend, building it on first use.
+returns None if the backend is not available (numba or cffi is not installed, or there is no working C compiler);
+any other error while building the backend is a bug and is raised.
+'''
+def get_backend(name):
+  if name not in backends:
+    try:
+      backends[name] = BACKEND_BUILDERS[name]()
+    except (ImportError, BackendUnavailable):
+      backends[name] = None
+  return backends[name]
+
+'''
+define a function that returns the environment tables in the types the kernels take, converted once per environment
+'''
+def get_kernel_tables(environment):
+  if 'kernel_tables' not in environment.__dict__:
+    environment.kernel_tables = (np.ascontiguousarray(environment.next_state, dtype=np.int32),
+                                 np.ascontiguousarray(environment.terminal, dtype=np.int8),
+                                 np.ascontiguousarray(environment.state_rewards, dtype=np.float64),
+                                 np.ascontiguousarray(environment.starting_states, dtype=np.int32))
+  return environment.kernel_tables
+
+'''
+define a sequential training loop that runs whole episodes on the chosen backend, with a seeded random number generator.
+to continue one random stream over several calls, pass the same rng_state (a one element uint64 array) to every call
+instead of a seed. returns the length and the largest absolute temporal difference of every episode.
+'''
+def train_sequential(environment, q_table, episodes, epsilon, discount_factor, learning_rate, seed=0, backend='python',
+                     rng_state=None):
+  kernel = get_backend(backend)
+  if kernel is None:
+    raise RuntimeError("backend '{}' is not available".format(backend))
+  if q_table.dtype != np.float64 or not q_table.flags['C_CONTIGUOUS']:
+    raise ValueError('q_table must be a C-contiguous float64 array')
+  if rng_state is None:
+    rng_state = np.array([seed & MASK_64], dtype=np.uint64)
+  episode_lengths, max_differences = np.zeros(episodes, dtype=np.int64), np.zeros(episodes)
+  kernel(*get_kernel_tables(environment), q_table, episodes, rng_state, epsilon, discount_factor, learning_rate,
+         episode_lengths, max_differences)
+  return episode_lengths, max_differences
+
+'''
+define a microbenchmark that trains a fresh Q-table with every available backend, reports the steps per second, and
+checks that each backend's Q-table matches the reference 'python' backend bit for bit.
+'''
+def benchmark_backends(environment, episodes=1000, seed=0, epsilon=0.9, discount_factor=0.9, learning_rate=0.9):
+  reference = None
+  results = {}
+  for name in BACKEND_BUILDERS:
+    if get_backend(name) is None:
+      print('{:>8}: not available'.format(name))
+      continue
+    #warm up (e.g. numba compilation) before timing
+    train_sequential(environment, np.zeros((environment.n_states, 4)), 1, epsilon, discount_factor, learning_rate, seed, name)
+    table = np.zeros((environment.n_states, 4))
+    start = time.perf_counter()
+    steps = train_sequential(environment, table, episodes, epsilon, discount_factor, learning_rate, seed, name)[0].sum()
+    elapsed = time.perf_counter() - start
+    if reference is None:
+      reference = table
+    matches = np.array_equal(table.view(np.uint64), reference.view(np.uint64))
+    results[name] = steps / elapsed
+    print('{:>8}: {:>14,.0f} steps/s ({} steps, matches reference: {})'.format(name, steps / elapsed, steps, matches))
+  return results
+
+'''
+define the default training parameters
+'''
+DEFAULT_CONFIG = {
+  'episodes': 1000, #the number of training episodes
+  'n_agents': 50, #the number of agents trained at a time by the 'batched' backend
+  'epsilon': 0.9, #the percentage of time when we should take the best action (instead of a random action)
+  'discount_factor': 0.9, #discount factor for future rewards
+  'learning_rate': 0.9, #the rate at which the AI agent should learn
+  'backend': 'batched', #'batched', or one of the sequential backends ('python', 'numba', 'cffi')
+  'dtype': 'float64', #the Q-table type; 'float32' halves the memory of large grids ('batched' backend only)
+  'stop': None, #stop early: 'delta' (max |TD| below tolerance) or 'policy' (greedy policy unchanged), over a window
+  'tolerance': 1e-3, #the largest absolute temporal difference that counts as converged for stop='delta'
+  'window': 100, #the number of consecutive episodes the stopping rule must hold for
+  'report_every': 100, #episodes between policy measurements and stopping checks (only with a callback or a stop rule)
+}
+
+'''
+define a function that returns the fraction of starting states whose greedy action is optimal
+'''
+def policy_optimality(environment, q_table):
+  return 1. - len(check_policy(environment, q_table)) / len(environment.starting_states)
+
+'''
+define a function that returns the fraction of starting states whose greedy path reaches a goal
+(pass the greedy actions as next_action if they are already known)
+'''
+def greedy_reach_fraction(environment, q_table, next_action=None):
+  destinations = follow_next_hops(environment, q_table.argmax(axis=1) if next_action is None else next_action)
+  return float(goal_states(environment)[destinations[environment.starting_states]].mean())
+
+'''
+define a generator that trains a Q-table in chunks of report_every episodes (one chunk, i.e. a single call of the
+training loop, for the whole budget if report_every is None) and yields the telemetry of each chunk: the length and
+the largest absolute temporal difference of each of its episodes (arrays) and, with policy_metrics, the fraction of
+starting states whose greedy path reaches a goal and whether the greedy policy changed, measured at the end of the chunk
+(otherwise None). the sequential backends continue one random stream over the chunks, so their Q-table does not
+depend on report_every; the 'batched' backend starts a new set of agents in every chunk.
+'''
+def train_chunks(config, seed, environment, q_table, report_every=None, policy_metrics=True):
+  rng = np.random.default_rng(seed)
+  rng_state = None if config['backend'] == 'batched' else np.array([rng.integers(2**63)], dtype=np.uint64)
+  report_every = report_every or config['episodes']
+  policy = q_table.argmax(axis=1) if policy_metrics else None
+  episodes_done = 0
+  while episodes_done < config['episodes']:
+    episodes = min(report_every, config['episodes'] - episodes_done)
+    if config['backend'] == 'batched':
+      lengths, max_differences = train_batched(environment, q_table, episodes, config['n_agents'], config['epsilon'],
+                                               config['discount_factor'], config['learning_rate'], rng)
+    else:
+      lengths, max_differences = train_sequential(environment, q_table, episodes, config['epsilon'],
+                                                  config['discount_factor'], config['learning_rate'],
+                                                  backend=config['backend'], rng_state=rng_state)
+    episodes_done += episodes
+    reach_fraction = policy_changed = None
+    if policy_metrics:
+      new_policy = q_table.argmax(axis=1)
+      policy_changed = not np.array_equal(new_policy[environment.starting_states], policy[environment.starting_states])
+      policy = new_policy
+      reach_fraction = greedy_reach_fraction(environment, q_table, policy)
+    yield lengths, max_differences, reach_fraction, policy_changed
+
+'''
+define an iterator over the training of a Q-table that yields the telemetry of every episode: the episode number,
+its length, its largest absolute temporal difference (max_td), the fraction of starting states whose greedy path
+reaches a goal (reach_fraction) and whether the greedy policy changed (policy_changed).
+episodes are trained in chunks of report_every episodes (by default config['report_every']); reach_fraction and
+policy_changed are measured at the end of each chunk.
+the q_table is updated in place, and training stops when the iterator is no longer consumed.
+'''
+def train_iter(config=None, seed=None, environment=environment, q_table=None, report_every=None):
+  config = {**DEFAULT_CONFIG, **(config or {})}
+  if q_table is None:
+    q_table = np.zeros((environment.n_states, 4), dtype=config['dtype'])
+  episodes_done = 0
+  for lengths, max_differences, reach_fraction, policy_changed in train_chunks(
+      config, seed, environment, q_table, report_every or config['report_every']):
+    for length, max_difference in zip(lengths.tolist(), max_differences.tolist()):
+      episodes_done += 1
+      yield {'episode': episodes_done, 'length': length, 'max_td': max_difference, 'reach_fraction': reach_fraction,
+             'policy_changed': policy_changed}
+
+'''
+define the trainer: trains a Q-table for the given config (missing keys fall back to DEFAULT_CONFIG) and seed, and
+returns it. callback(telemetry, q_table) is called after every episode with the telemetry from train_iter, plus
+stop_episode: the episode at which the stopping rule was met (None until then).
+with config['stop'] set, training stops early once the max |TD| of the last `window` episodes is below `tolerance`
+('delta'), or the greedy policy has not changed for `window` episodes ('policy').
+without a callback or a stopping rule the whole budget is trained in one call of the training loop; otherwise the
+policy is measured and the stopping rule checked every report_every episodes (by default config['report_every']).
+training stops at the end of the chunk in which the rule is met, so the Q-table has been trained on up to
+report_every - 1 episodes after stop_episode; the callback still gets every episode that was trained.
+a q_table to continue training can be passed in.
+'''
+def train(config=None, seed=None, environment=environment, q_table=None, report_every=None, callback=None):
+  config = {**DEFAULT_CONFIG, **(config or {})}
+  if q_table is None:
+    q_table = np.zeros((environment.n_states, 4), dtype=config['dtype'])
+  if callback is None and config['stop'] is None:
+    report_every = None
+  else:
+    report_every = report_every or config['report_every']
+  policy_metrics = callback is not None or config['stop'] == 'policy'
+
+  calm_episodes = 0 #consecutive episodes with a max |TD| within the tolerance
+  stable_episodes = 0 #consecutive episodes without a change of the greedy policy
+  episodes_done = 0
+  for lengths, max_differences, reach_fraction, policy_changed in train_chunks(
+      config, seed, environment, q_table, report_every, policy_metrics):
+    stop_after = None #the number of episodes of this chunk up to the one that met the stopping rule
+    if config['stop'] == 'delta':
+      positions = np.arange(len(max_differences))
+      last_above = np.maximum.accumulate(np.where(max_differences > config['tolerance'], positions, -calm_episodes - 1))
+      calm = positions - last_above
+      met = np.flatnonzero(calm >= config['window'])
+      if len(met):
+        stop_after = met[0] + 1
+      calm_episodes = int(calm[-1])
+    elif config['stop'] == 'policy':
+      stable_episodes = 0 if policy_changed else stable_episodes + len(lengths)
+      if stable_episodes >= config['window']:
+        stop_after = len(lengths)
+
+    stop_episode = None if stop_after is None else episodes_done + int(stop_after)
+    if callback is not None:
+      for length, max_difference in zip(lengths.tolist(), max_differences.tolist()):
+        episodes_done += 1
+        callback({'episode': episodes_done, 'length': length, 'max_td': max_difference,
+                  'reach_fraction': reach_fraction, 'policy_changed': policy_changed,
+                  'stop_episode': stop_episode if stop_episode is not None and episodes_done >= stop_episode else None},
+                 q_table)
+    if stop_episode is not None:
+      break
+  return q_table
+
+'''
+define functions that build the list of configs for a sweep: every combination of a grid of values, or n random
+samples where each value is either a list to choose from or a (low, high) range to draw uniformly from
+'''
+def grid_search(grid):
+  return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+def random_search(space, n, seed=None):
+  rng = np.random.default_rng(seed)
+  configs = []
+  for trial in range(n):
+    configs.append({key: float(rng.uniform(*values)) if isinstance(values, tuple)
+                    else values[rng.integers(len(values))] for key, values in space.items()})
+  return configs
+
+'''
+define one trial of a sweep (run in a worker process): trains a config with the trial's own random number generator,
+spawned from the root seed, recording the fraction of optimal greedy actions and the telemetry every report_every
+episodes (and at the last episode trained, if the trial stopped early; stop_episode is where its stopping rule was met)
+'''
+def run_trial(trial, config, seed, environment, report_every):
+  curve = []
+  start = time.perf_counter()
+  last = {}
+
+  def record(telemetry, q_table):
+    last.update(telemetry, optimality=None)
+    if telemetry['episode'] % report_every == 0:
+      last['optimality'] = policy_optimality(environment, q_table)
+      curve.append({'trial': trial, **config, 'seed': seed, 'episodes_done': telemetry['episode'],
+                    'optimality': last['optimality'], 'max_td': telemetry['max_td'],
+                    'reach_fraction': telemetry['reach_fraction'], 'stop_episode': telemetry['stop_episode'],
+                    'seconds': time.perf_counter() - start})
+
+  #the same stream as np.random.SeedSequence(seed).spawn(...)[trial]
+  q_table = train(config, np.random.SeedSequence(seed, spawn_key=(trial,)), environment, report_every=report_every,
+                  callback=record)
+  if last and last['optimality'] is None:
+    curve.append({'trial': trial, **config, 'seed': seed, 'episodes_done': last['episode'],
+                  'optimality': policy_optimality(environment, q_table), 'max_td': last['max_td'],
+                  'reach_fraction': last['reach_fraction'], 'stop_episode': last['stop_episode'],
+                  'seconds': time.perf_counter() - start})
+  return curve
+
+'''
+define the sweep runner: fans every (config, repeat) trial out over a process pool. each trial gets its own
+independent random number generator spawned from one root seed, so the sweep is reproducible regardless of how
+trials are scheduled on the workers. returns the convergence curves of all trials in one table.
+'''
+def run_sweep(configs, repeats=1, seed=0, environment=environment, report_every=100, workers=None):
+  trials = [{**DEFAULT_CONFIG, **config} for config in configs for repeat in range(repeats)]
+  with ProcessPoolExecutor(max_workers=workers) as executor:
+    curves = executor.map(run_trial, range(len(trials)), trials, itertools.repeat(seed), itertools.repeat(environment),
+                          itertools.repeat(report_every))
+    return pd.DataFrame([row for curve in curves for row in curve])
+
+'''
+define functions that save a checkpoint (the compiled environment and the Q-table as .npy files in one directory) and
+load it back. by default the Q-table is memory-mapped read-only, so path-serving processes start without retraining
+and share one copy of the table; pass mmap_mode=None to load a private, writable copy instead.
+'''
+def save_checkpoint(directory, environment, q_table):
+  environment.save(directory)
+  save_array(os.path.join(directory, 'q_table.npy'), np.asarray(q_table))
+
+def load_checkpoint(directory, mmap_mode='r'):
+  return (WarehouseEnvironment.load(directory, mmap_mode),
+          np.load(os.path.join(directory, 'q_table.npy'), mmap_mode=mmap_mode))
+
+'''
+define a warm start: maps the Q-values of a checkpoint onto a (slightly) changed warehouse layout, by (row, column)
+location. locations without a state in the old environment start from zero, and so do terminal states, whose Q-values
+must stay 0. returns a new, writable Q-table (of the same type) to continue training from.
+'''
+def warm_start(q_table, old_environment, environment):
+  new_q_table = np.zeros((environment.n_states, 4), dtype=q_table.dtype)
+  rows, columns = np.divmod(environment.cells, environment.columns)
+  inside = (rows < old_environment.rows) & (columns < old_environment.columns)
+  old_states = np.full(environment.n_states, -1)
+  old_states[inside] = old_environment.cell_states[rows[inside] * old_environment.columns + columns[inside]]
+  mapped = old_states >= 0
+  new_q_table[mapped] = q_table[old_states[mapped]]
+  new_q_table[environment.terminal == 1] = 0.
+  return new_q_table
+
+if __name__ == "__main__":
+  #train on a warehouse layout file instead of the demo grid (python q_learning.py --layout <file>), see load_layout
+  layout = sys.argv[sys.argv.index('--layout') + 1] if '--layout' in sys.argv else None
+  if layout:
+    environment = WarehouseEnvironment.from_layout(layout)
+    q_table = np.zeros((environment.n_states, 4), dtype=DEFAULT_CONFIG['dtype'])
+    print('Loaded a {}x{} layout with {} states from {}'.format(environment.rows, environment.columns,
+                                                                 environment.n_states, layout))
+  else:
+    '''
+    print rewards matrix
+    '''
+    print("\t\t\tRewards Matrix")
+    for row in rewards:
+      print(row)
+
+  #reuse a saved checkpoint (python q_learning.py --checkpoint <directory>): load it if the layout is unchanged,
+  #warm start from it if the layout changed, and save the trained Q-table to it
+  checkpoint = sys.argv[sys.argv.index('--checkpoint') + 1] if '--checkpoint' in sys.argv else None
+  saved_environment = saved_q_table = None
+  if checkpoint and os.path.exists(os.path.join(checkpoint, 'q_table.npy')):
+    saved_environment, saved_q_table = load_checkpoint(checkpoint)
+  if saved_environment is not None and saved_environment.same_layout(environment):
+    q_table[:] = saved_q_table
+    print('Loaded the Q-table from', checkpoint)
+  else:
+    if saved_environment is not None:
+      q_table[:] = warm_start(saved_q_table, saved_environment, environment)
+      print('Warm starting from', checkpoint)
+    #run through 1000 training episodes, 50 agents at a time
+    train(DEFAULT_CONFIG, environment=environment, q_table=q_table)
+    print('Training complete!')
+    if checkpoint:
+      saved_environment = saved_q_table = None #release the memory maps before replacing the files
+      save_checkpoint(checkpoint, environment, q_table)
+
+  #check the learned policy against the exact solution
+  disagreements = check_policy(environment, q_table)
+  print('Learned policy agrees with the exact solution in {} of {} starting states'.format(
+    len(environment.starting_states) - len(disagreements), len(environment.starting_states)))
+
+  #compare the training backends (python q_learning.py --benchmark)
+  if '--benchmark' in sys.argv:
+    print("\t\t\tTraining backends")
+    benchmark_backends(environment, 20000)
+
+  #compare training settings (python q_learning.py --sweep)
+  if '--sweep' in sys.argv:
+    print("\t\t\tParameter sweep")
+    sweep = run_sweep(grid_search({'epsilon': [0.7, 0.9], 'learning_rate': [0.5, 0.9]}), repeats=3,
+                      environment=environment)
+    print(sweep.groupby(['epsilon', 'learning_rate', 'episodes_done'])['optimality'].mean().unstack())
+
+  #display a few shortest paths
+  if layout:
+    #from the first starting states of the layout file
+    for state in environment.starting_states[:3]:
+      row, column = environment.location(state)
+      print("\t\t\tShortest path from ({},{})".format(row, column))
+      print(get_shortest_path(row, column, environment, q_table))
+      print("\t\t\tExact shortest path from ({},{})".format(row, column))
+      #solved with the least cost search, since the aisles of a layout can cost different amounts
+      print(get_shortest_path(row, column, environment, q_table, solver='least_cost'))
+  else:
+    print("\t\t\tShortest path from (3,9)")
+    print(get_shortest_path(3, 9)) #starting at row 3, column 9
+    print("\t\t\tShortest path from (5,0)")
+    print(get_shortest_path(5, 0)) #starting at row 5, column 0
+    print("\t\t\tShortest path from (9,5)")
+    print(get_shortest_path(9, 5)) #starting at row 9, column 5
+    print("\t\t\tExact shortest path from (9,5)")
+    print(get_shortest_path(9, 5, solver='bfs')) #solved directly instead of learned
+
+    #display an example of reversed shortest path
+    print("\t\t\tReverse shortest path from (0,5) to (5,2)")
+    path = get_shortest_path(5, 2) #go to row 5, column 2
+    path.reverse()
+    print(path)